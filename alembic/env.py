@@ -8,7 +8,7 @@ from src.models.auth import User
 from src.models.invoices import Invoice, InvoiceProductList, InvoiceMetadata, Transaction
 from src.models.parties import PartyMaster
 from src.models.products import ProductMaster, ProductQtyConverter
-from src.models.system_config import SystemConfig
+from src.models.system_config import SystemConfig, DataVersion
 from alembic import context
 from sqlalchemy.ext.asyncio import async_engine_from_config, AsyncEngine
 import asyncio
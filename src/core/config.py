@@ -14,6 +14,53 @@ class Settings:
         os.getenv("REFRESH_TOKEN_EXPIRE_DAYS"))
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY")
     JWT_ALGORITHM: str = os.getenv("JWT_ALGORITHM")
-    
+
+    # Streaming CSV upload (/invoices/file_upload with stream=true)
+    UPLOAD_CHUNK_SIZE_KB: int = int(os.getenv("UPLOAD_CHUNK_SIZE_KB", 1024))
+    UPLOAD_BATCH_SIZE: int = int(os.getenv("UPLOAD_BATCH_SIZE", 5000))
+    # Approximate ceiling on raw CSV text held in memory for one batch
+    UPLOAD_MEMORY_LIMIT_MB: int = int(os.getenv("UPLOAD_MEMORY_LIMIT_MB", 64))
+
+    # Background upload jobs (/invoices/file_upload with background=true)
+    UPLOAD_JOB_CONCURRENCY: int = int(os.getenv("UPLOAD_JOB_CONCURRENCY", 1))
+    UPLOAD_JOB_MAX_PENDING: int = int(os.getenv("UPLOAD_JOB_MAX_PENDING", 10))
+    # Pause between batches so scan requests get the event loop and the DB in between
+    UPLOAD_JOB_BATCH_PAUSE_MS: int = int(os.getenv("UPLOAD_JOB_BATCH_PAUSE_MS", 50))
+    # Jobs read smaller batches than UPLOAD_BATCH_SIZE: the parsing and SQL parameter building of one
+    # batch still run on the event loop, so the batch size bounds how long a scan can wait behind it
+    UPLOAD_JOB_BATCH_SIZE: int = int(os.getenv("UPLOAD_JOB_BATCH_SIZE", 1000))
+    UPLOAD_JOB_RETENTION_MINUTES: int = int(os.getenv("UPLOAD_JOB_RETENTION_MINUTES", 60))
+
+    # Product master row normalisation runs in a process pool; 0 workers (the default) keeps it on the
+    # event loop, which is faster on a single core
+    UPLOAD_NORMALIZE_WORKERS: int = int(os.getenv("UPLOAD_NORMALIZE_WORKERS", 0))
+    UPLOAD_NORMALIZE_CHUNK_SIZE: int = int(os.getenv("UPLOAD_NORMALIZE_CHUNK_SIZE", 2000))
+
+    # dry_run=true upload reports keep at most this many errors (and warnings); counts stay exact
+    UPLOAD_DRY_RUN_MAX_ERRORS: int = int(os.getenv("UPLOAD_DRY_RUN_MAX_ERRORS", 1000))
+
+    # GET /invoices/ cursor pages reuse the count of the same filters for this long; 0 counts every request
+    INVOICES_COUNT_CACHE_SECONDS: int = int(os.getenv("INVOICES_COUNT_CACHE_SECONDS", 30))
+    INVOICES_COUNT_CACHE_SIZE: int = int(os.getenv("INVOICES_COUNT_CACHE_SIZE", 256))
+
+    # /products/match/scan answers from an in-memory copy of product_master instead of querying it
+    PRODUCT_MATCH_IN_MEMORY: bool = os.getenv("PRODUCT_MATCH_IN_MEMORY", "false").lower() == "true"
+    # Read every candidate of a scan in one UNION ALL query instead of one query per search step
+    PRODUCT_MATCH_SINGLE_QUERY: bool = os.getenv("PRODUCT_MATCH_SINGLE_QUERY", "false").lower() == "true"
+    # Fuzzy batch matching keeps every candidate batch whose rapidfuzz WRatio score reaches the cutoff
+    PRODUCT_MATCH_FUZZY_SCORE_CUTOFF: int = int(os.getenv("PRODUCT_MATCH_FUZZY_SCORE_CUTOFF", 80))
+    # rapidfuzz cdist threads per scoring call; -1 uses every CPU
+    PRODUCT_MATCH_FUZZY_WORKERS: int = int(os.getenv("PRODUCT_MATCH_FUZZY_WORKERS", 1))
+    # Search the scanned invoice's own lines before the whole product master
+    PRODUCT_MATCH_INVOICE_FIRST: bool = os.getenv("PRODUCT_MATCH_INVOICE_FIRST", "false").lower() == "true"
+    PRODUCT_MATCH_INVOICE_CACHE_SECONDS: int = int(os.getenv("PRODUCT_MATCH_INVOICE_CACHE_SECONDS", 600))
+    PRODUCT_MATCH_INVOICE_CACHE_SIZE: int = int(os.getenv("PRODUCT_MATCH_INVOICE_CACHE_SIZE", 256))
+
+    # Cache of /products/match/scan responses per scanned batch / expiry / MRP; size 0 disables it
+    MATCH_SCAN_CACHE_SIZE: int = int(os.getenv("MATCH_SCAN_CACHE_SIZE", 4096))
+    MATCH_SCAN_CACHE_SECONDS: int = int(os.getenv("MATCH_SCAN_CACHE_SECONDS", 300))
+    # Add the per-stage timings of every match_scan to the /products/match/scan/metrics histograms
+    MATCH_SCAN_TRACE: bool = os.getenv("MATCH_SCAN_TRACE", "false").lower() == "true"
+
 
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.core.config import settings
+from src.logger.logger_setup import logger
+import asyncio
+import multiprocessing
+
+_process_pool: ProcessPoolExecutor | None = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Shared pool for CPU-bound upload work, created on first use with UPLOAD_NORMALIZE_WORKERS processes.
+    Workers are spawned rather than forked so they never inherit locks held by the server's threads.
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=settings.UPLOAD_NORMALIZE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        logger.info(f"Process pool started with {settings.UPLOAD_NORMALIZE_WORKERS} workers")
+    return _process_pool
+
+
+async def run_in_process_pool(func, *args):
+    """
+    func and args must be picklable, i.e. module-level functions and plain data.
+    A worker that exits abruptly (e.g. killed for memory) breaks the whole pool: it is then replaced
+    and the call retried once on the new pool.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        logger.error("Process pool broken by a worker that exited abruptly, starting a new one")
+        discard_process_pool(pool)
+        return await loop.run_in_executor(get_process_pool(), func, *args)
+
+
+def discard_process_pool(pool: ProcessPoolExecutor):
+    """Drops a broken pool so the next get_process_pool starts a new one; concurrent callers discard it once."""
+    global _process_pool
+    if _process_pool is pool:
+        _process_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+        logger.info("Process pool shut down")
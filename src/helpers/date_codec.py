@@ -0,0 +1,99 @@
+"""
+Date parsing / formatting shared by uploads and metrics.
+Master files repeat a few hundred expiry / mfg values across many rows, so month dates are
+cached per (value, date_type). The fixed layouts (Mon-YY, MM-YYYY, Mon-YYYY, DD-MM-YYYY HH:MM:SS)
+are parsed by hand; anything else goes through strptime exactly as before.
+"""
+from datetime import datetime
+from functools import lru_cache
+from src.logger.logger_setup import logger
+import calendar
+
+MONTH_DATE_CACHE_SIZE = 4096
+
+MONTH_ABBR = {name.lower(): index for index, name in enumerate(calendar.month_abbr) if name}
+
+
+def _two_digit_year(value: int) -> int:
+    # Same pivot as strptime %y: 69-99 → 1900s, 00-68 → 2000s
+    return value + 1900 if value >= 69 else value + 2000
+
+
+def _fast_month_date(date_str: str):
+    """Returns (year, month) for Mon-YY, MM-YYYY and Mon-YYYY, None for any other layout."""
+    head, sep, tail = date_str.partition("-")
+    if not sep or not tail.isascii() or not tail.isdigit():
+        return None
+
+    if len(tail) == 2 and len(head) == 3:
+        month = MONTH_ABBR.get(head.lower())
+        return (_two_digit_year(int(tail)), month) if month else None
+
+    if len(tail) == 4:
+        if len(head) == 3 and head.isalpha():
+            month = MONTH_ABBR.get(head.lower())
+        elif 1 <= len(head) <= 2 and head.isascii() and head.isdigit():
+            month = int(head)
+        else:
+            return None
+        return (int(tail), month) if month and 1 <= month <= 12 and int(tail) >= 1000 else None
+    return None
+
+
+def _slow_month_date(date_str: str, date_type: str) -> str:
+    """The original strptime based parser, used for layouts the fast path does not recognise."""
+    try:
+        date_str = date_str.strip()
+        # Handle "Nov-24" (month abbreviation + 2-digit year)
+        if "-" in date_str and len(date_str.split("-")[1]) == 2:
+            parsed_date = datetime.strptime(date_str, "%b-%y")
+
+        # Handle "11-2025" (MM-YYYY)
+        elif "-" in date_str and len(date_str.split("-")[1]) == 4:
+            parsed_date = datetime.strptime(date_str, "%b-%Y") if date_str[:3].isalpha() else datetime.strptime(date_str, "%m-%Y")
+
+        # Handle full date (if given)
+        else:
+            parsed_date = datetime.strptime(date_str, "%Y-%m-%d")
+
+        if date_type.lower() == "mfg":
+            parsed_date = parsed_date.replace(day=1)
+        elif date_type.lower() == "expiry":
+            last_day = calendar.monthrange(parsed_date.year, parsed_date.month)[1]
+            parsed_date = parsed_date.replace(day=last_day)
+
+        return parsed_date.strftime("%d-%m-%Y")
+
+    except Exception as e:
+        logger.warning(f" Could not parse date '{date_str}', using current date instead.")
+        return date_str
+
+
+@lru_cache(maxsize=MONTH_DATE_CACHE_SIZE)
+def parse_month_date(date_str: str, date_type: str) -> str:
+    """
+    'Nov-24' / '11-2024' / 'Nov-2024' → 'DD-MM-YYYY', day 1 for mfg dates and the last day
+    of the month for expiry dates. Unparseable values are returned unchanged.
+    """
+    parsed = _fast_month_date(date_str.strip()) if isinstance(date_str, str) else None
+    if parsed is None:
+        return _slow_month_date(date_str, date_type)
+
+    year, month = parsed
+    kind = date_type.lower()
+    if kind == "expiry":
+        day = calendar.monthrange(year, month)[1]
+    else:
+        day = 1
+    return f"{day:02d}-{month:02d}-{year:04d}"
+
+
+def parse_dmy_hms(value: str) -> datetime:
+    """'DD-MM-YYYY HH:MM:SS' → datetime. Raises ValueError like strptime for invalid values."""
+    if (len(value) == 19 and value[2] == "-" and value[5] == "-" and value[10] == " "
+            and value[13] == ":" and value[16] == ":"):
+        parts = (value[6:10], value[3:5], value[0:2], value[11:13], value[14:16], value[17:19])
+        if all(part.isascii() and part.isdigit() for part in parts):
+            return datetime(*map(int, parts))
+    return datetime.strptime(value, "%d-%m-%Y %H:%M:%S")
+
@@ -4,7 +4,10 @@ from sqlalchemy import or_, text
 from fastapi import HTTPException
 from src.logger.logger_setup import logger
 from datetime import datetime,timedelta
-import calendar
+from src.helpers.date_codec import parse_month_date
+import re
+import base64
+import json
 
 class FileUploadType(str, Enum):
     invoice = "invoice"
@@ -16,6 +19,25 @@ class FileUploadType(str, Enum):
 class FlowType(str, Enum):
     picker = "picker"
     checker = "checker"
+
+
+class PaginationMode(str, Enum):
+    offset = "offset"
+    cursor = "cursor"
+
+
+# Characters match_scan strips from a scanned batch number
+SCAN_BATCH_STRIP_PATTERN = re.compile('[ @#$%^&*()!?-]')
+# Letters OCR reads where the batch has a digit
+BATCH_KEY_OCR_MAP = str.maketrans({"O": "0", "I": "1"})
+
+
+def normalize_batch_key(batch_number) -> str:
+    """
+    product_master.batch_key: the batch number cleaned like match_scan cleans a scan, upper-cased,
+    with O → 0 and I → 1, so 'ab-1O2' and 'AB 102' both become 'AB102'.
+    """
+    return SCAN_BATCH_STRIP_PATTERN.sub("", str(batch_number or "")).upper().translate(BATCH_KEY_OCR_MAP)
      
     
 def list_invoices_base_query():
@@ -31,7 +53,11 @@ def list_invoices_base_query():
             p.id,
             p.party_code,
             p.party_name,
-            p.active AS party_active
+            p.active AS party_active,
+
+            i.list_group_picker,
+            i.list_group_checker,
+            i.priority_rank
 
         FROM invoices i
         JOIN party_master p ON p.id = i.party_id
@@ -40,6 +66,22 @@ def list_invoices_base_query():
     return base_query
 
 
+def encode_invoices_cursor(sort_key: list) -> str:
+    """Opaque GET /invoices/ cursor: the sort key values of the last invoice of a page."""
+    return base64.urlsafe_b64encode(json.dumps(sort_key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_invoices_cursor(cursor: str, key_count: int) -> list:
+    try:
+        sort_key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        sort_key = None
+    if not isinstance(sort_key, list) or len(sort_key) != key_count:
+        logger.error("decode_invoices_cursor: Invalid cursor")
+        raise HTTPException(status_code=400, detail={"status":"error","message":"Invalid cursor"})
+    return sort_key
+
+
 def invoices_return_structure(rows):
     try:
         invoice_map: Dict[str, Dict] = {}
@@ -132,6 +174,22 @@ async def check_invoice_exists(db, invoice_id: str) -> bool:
                 "message" : str(e).split("\n")[0][:100]})
 
 
+async def existing_invoice_ids(db, invoice_ids) -> set:
+    """The subset of invoice_ids present in invoices, in one query."""
+    try:
+        invoice_ids = list(set(invoice_ids))
+        if not invoice_ids:
+            return set()
+        placeholders = ", ".join([f":invoice_id{i}" for i in range(len(invoice_ids))])
+        params = {f"invoice_id{i}": invoice_id for i, invoice_id in enumerate(invoice_ids)}
+        result = await db.execute(text(f"SELECT id FROM invoices WHERE id IN ({placeholders})"), params)
+        return {row.id for row in result}
+    except Exception as e:
+        logger.exception(f"inside existing_invoice_ids: {e}")
+        raise HTTPException(status_code=404, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
 async def check_duplicate_csv_product_master(rows):
     try:
         seen = set()
@@ -156,32 +214,8 @@ async def check_duplicate_csv_product_master(rows):
         
         
 def parse_expiry_or_mfg_date(date_str: str,date_type:str) -> str:
-    """Parses 'Nov-24' or '2025-10-31' → returns formatted date string."""
-    try:
-        date_str = date_str.strip()
-        # Handle "Nov-24" (month abbreviation + 2-digit year)
-        if "-" in date_str and len(date_str.split("-")[1]) == 2:
-            parsed_date = datetime.strptime(date_str, "%b-%y")
-
-        # Handle "11-2025" (MM-YYYY)
-        elif "-" in date_str and len(date_str.split("-")[1]) == 4:
-            parsed_date = datetime.strptime(date_str, "%b-%Y") if date_str[:3].isalpha() else datetime.strptime(date_str, "%m-%Y")
-
-        # Handle full date (if given)
-        else:
-            parsed_date = datetime.strptime(date_str, "%Y-%m-%d")
-            
-        if date_type.lower() == "mfg":
-            parsed_date = parsed_date.replace(day=1)
-        elif date_type.lower() == "expiry":
-            last_day = calendar.monthrange(parsed_date.year, parsed_date.month)[1]
-            parsed_date = parsed_date.replace(day=last_day)
-
-        return parsed_date.strftime("%d-%m-%Y")
-
-    except Exception as e:
-        logger.warning(f" Could not parse date '{date_str}', using current date instead.")
-        return date_str
+    """Parses 'Nov-24' or '11-2025' → returns formatted date string (cached, see date_codec)."""
+    return parse_month_date(date_str, date_type)
         
         
 def invoice_upload_date_format(date_str: str) -> str:
@@ -5,6 +5,7 @@ from contextlib import asynccontextmanager
 from fastapi.openapi.utils import get_openapi
 from src.constants import api_prefix
 from src.db.database import async_session, engine, Base
+from src.core.process_pool import shutdown_process_pool
 from sqlalchemy import text
 import uuid
 from datetime import datetime
@@ -36,7 +37,7 @@ async def lifespan(app: FastAPI):
     yield  # Hand control back to FastAPI runtime
 
     # Optional cleanup after shutdown
-    pass
+    shutdown_process_pool()
 
 
 app = FastAPI(title="Invoice Verification", lifespan=lifespan)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, Integer, ForeignKey, Enum, Float, ARRAY, JSON, UniqueConstraint
+from sqlalchemy import Column, String, Boolean, Integer, ForeignKey, Enum, Float, ARRAY, JSON, UniqueConstraint, Computed, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from src.db.database import Base
@@ -27,6 +27,19 @@ class InvoiceType(str, enum.Enum):
     sell = "sell"
 
 
+# Status group an invoice is listed under by GET /invoices/ for a flow:
+# 1 = still to do (not_started or in another stage), 2 = completed, 3 = done by this flow, 4 = anything else
+INVOICE_LIST_GROUP_SQL = """
+    CASE
+        WHEN is_completed = 0 AND status IN {open_statuses} THEN 1
+        WHEN is_completed = 1 THEN 2
+        WHEN is_completed = 0 AND status = '{final_status}' THEN 3
+        ELSE 4
+    END
+"""
+INVOICE_PRIORITY_RANK_SQL = "CASE priority WHEN 'HIGH' THEN 1 WHEN 'MEDIUM' THEN 2 WHEN 'LOW' THEN 3 END"
+
+
 class Invoice(Base):
     __tablename__ = "invoices"
 
@@ -56,6 +69,22 @@ class Invoice(Base):
         onupdate=lambda: datetime.now().strftime("%d-%m-%Y %H:%M:%S")
     )
 
+    # Sort keys of the invoices list, computed by the database so the list can seek on an index
+    list_group_picker = Column(Integer, Computed(INVOICE_LIST_GROUP_SQL.format(
+        open_statuses=('not_started', 'picking_start', 'checking_start', 'checking_end'),
+        final_status='picking_end'), persisted=False))
+    list_group_checker = Column(Integer, Computed(INVOICE_LIST_GROUP_SQL.format(
+        open_statuses=('not_started', 'checking_start', 'picking_start', 'picking_end'),
+        final_status='checking_end'), persisted=False))
+    priority_rank = Column(Integer, Computed(INVOICE_PRIORITY_RANK_SQL, persisted=False))
+
+    __table_args__ = (
+        # GET /invoices/ order (and cursor) per flow, and by priority alone when filtered on is_verified
+        Index('ix_invoices_list_picker', 'list_group_picker', 'priority_rank', 'id'),
+        Index('ix_invoices_list_checker', 'list_group_checker', 'priority_rank', 'id'),
+        Index('ix_invoices_priority_rank', 'priority_rank', 'id'),
+    )
+
     # Relationships
     party = relationship("PartyMaster", back_populates="invoices", passive_deletes=True)
     invoice_products = relationship("InvoiceProductList", back_populates="invoice", passive_deletes=True)
@@ -203,4 +232,30 @@ class PerformanceMetrics(Base):
 
     # Relationships
     operator = relationship("User", backref="performance_metrics")
-    invoice = relationship("Invoice", backref="performance_metrics", uselist=False)
\ No newline at end of file
+    invoice = relationship("Invoice", backref="performance_metrics", uselist=False)
+
+class UploadHistory(Base):
+    __tablename__ = "upload_history"
+
+    __table_args__ = (
+        UniqueConstraint("file_type", "file_hash", name="uq_upload_history_file"),
+    )
+
+    id = Column(String, primary_key=True, index=True)
+    file_type = Column(String, nullable=False)
+    file_hash = Column(String(64), nullable=False)   # sha256 of the uploaded bytes
+    filename = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)
+    result = Column(JSON, nullable=True)             # response of the upload that ingested the file
+    skipped_count = Column(Integer, nullable=False, default=0)
+    # Most recent successful upload of its file type; only that one is answered from history
+    is_latest = Column(Boolean, nullable=False, default=False, server_default="0")
+
+    updated_by = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+
+    created_at = Column(String, default=lambda: datetime.now().strftime("%d-%m-%Y %H:%M:%S"))
+    updated_at = Column(
+        String,
+        default=lambda: datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+        onupdate=lambda: datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, ForeignKey, Integer, UniqueConstraint
+from sqlalchemy import Column, String, Float, ForeignKey, Integer, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from src.db.database import Base
 import datetime
@@ -9,17 +9,21 @@ class ProductMaster(Base):
     id = Column(String, primary_key=True, index=True)
     item_code = Column(String, nullable=False)
     product_name = Column(String, nullable=False)
-    batch_number = Column(String, nullable=False)
+    batch_number = Column(String, nullable=False, index=True)
     expiry_date = Column(String, nullable=False)  # Format: MM-YYYY
     mfg_date = Column(String, nullable=True)     # Format: MM-YYYY
     mrp = Column(Float, nullable=False)
     rack_no = Column(String, nullable=True, default="0")
     division = Column(String, nullable=True)
     obatch = Column(String, nullable=True)
-    barcode1 = Column(String, nullable=True)
-    barcode2 = Column(String, nullable=True)
+    barcode1 = Column(String, nullable=True, index=True)
+    barcode2 = Column(String, nullable=True, index=True)
     optional1 = Column(String, nullable=True)
     optional2 = Column(String, nullable=True)
+    # batch_number normalised like a scanned batch (see normalize_batch_key)
+    batch_key = Column(String, nullable=True, index=True)
+    # Hash of the columns a product master upload can change, used by delta uploads
+    row_fingerprint = Column(String, nullable=True)
 
     # rack_id = Column(String, ForeignKey("rack_info.id"), nullable=True)
     updated_by = Column(String, ForeignKey("users.id"), nullable=True)
@@ -33,6 +37,9 @@ class ProductMaster(Base):
     
     __table_args__ = (
         UniqueConstraint('item_code', 'batch_number', 'expiry_date', 'mrp', name='unique_product_batch'),
+        # Finder fuzzy lookups: equality on expiry / mfg date plus an MRP range
+        Index('ix_product_master_expiry_date_mrp', 'expiry_date', 'mrp'),
+        Index('ix_product_master_mfg_date_mrp', 'mfg_date', 'mrp'),
     )
     
     
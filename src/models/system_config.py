@@ -24,3 +24,11 @@ class SystemConfig(Base):
     )
     
     
+
+
+class DataVersion(Base):
+    """Change counter of a table, bumped by every write that in-process caches of it must notice."""
+    __tablename__ = "data_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
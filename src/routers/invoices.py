@@ -7,16 +7,21 @@ from src.models.auth import User
 from src.models.invoices import PriorityLevel, InvoiceStatus
 
 #  *****************   Services Import  *******************
-from src.services.invoices import read_csv_file, invoices_apply_filters_search_pagination, prepare_invoice_upload_data, \
+from src.services.invoices import read_csv_file, invoices_apply_filters_search_pagination, invoices_apply_filters_search_cursor, prepare_invoice_upload_data, \
         save_invoice_upload_data, paginate_query, get_invoice_details, prepare_party_master_data, save_party_master_data, \
         prepare_product_master_data, save_product_master_data, check_rack_no_rack_master, prepare_rack_master_data, \
         save_rack_master_data, delete_invoice_product, add_invoice_product, preparing_fields_invoice_metadata, \
         insert_into_invoice_metadata, add_transactions, check_tray_no_tray_master, prepare_tray_master_data, save_tray_master_data, \
         get_user_productivity_report, compute_performance_metrics, detect_operation_status
+from src.services.uploads import process_upload_stream, UPLOAD_SUCCESS_MESSAGES, create_upload_job, get_upload_job, \
+        is_compressed_upload, process_upload_bundle, upload_file_hash, get_cached_upload, save_upload_history, \
+        forget_uploads
+from src.services.upload_validation import validate_upload_stream
+from src.services.product_catalog import invalidate_invoice_matches
 from src.services.user_services import get_current_user
 
 #  *****************  Helpers Import  *******************
-from src.helpers.invoices import FileUploadType, FlowType,list_invoices_base_query, invoices_return_structure, list_invoices_products_base_query, \
+from src.helpers.invoices import FileUploadType, FlowType, PaginationMode,list_invoices_base_query, invoices_return_structure, list_invoices_products_base_query, \
             check_invoice_exists, check_duplicate_csv_product_master,update_invoice_status, epoch_to_str,check_invoice_metadata_fields_exist, \
             invoices_metadata_field_map , invoice_metadata_row_exists, check_invoice_product_exists
             
@@ -38,66 +43,120 @@ router = APIRouter(tags=["Invoices"])
 async def file_upload(db: AsyncSession = Depends(get_db),
                     file:UploadFile = File(...), 
                     value: FileUploadType = Form(...),
+                    stream: bool = Form(False),
+                    background: bool = Form(False),
+                    delta: bool = Form(False),
+                    dry_run: bool = Form(False),
+                    force: bool = Form(False),
                     current_user: User = Depends(get_current_user)):
 
     """ Uploads and processes CSV files for Invoice, Party Master, Product Master, Rack Master, and Tray Master.
         Product Master file must be uploaded before Invoice upload to ensure proper rack mapping.
-        Validates, prepares, and stores data based on the selected upload type."""
+        Validates, prepares, and stores data based on the selected upload type.
+        stream=true reads the file in chunks and processes it in fixed-size batches with bounded memory,
+        returning rows parsed / written and rows per second. Master files are committed batch by batch:
+        if a batch fails, the batches before it stay stored and the error reports them as rows_committed.
+        Invoice files are all-or-nothing, but their prepared rows are held in memory until the single save,
+        so only the raw CSV text is bounded for them.
+        background=true queues the streamed upload as a job and returns its job_id immediately;
+        progress is available from GET /file_upload/jobs/{job_id}.
+        delta=true (product master) only writes new or changed rows and returns inserted/updated/unchanged counts.
+        dry_run=true validates the whole file without writing anything and returns every error with its row number.
+        .csv.gz and .zip (one CSV inside) files are decompressed as a stream and always use the stream mode.
+        A file that was the last one uploaded successfully for the same type returns the stored result with
+        cached=true instead of being processed again; force=true processes it anyway."""
 
     try:
         logger.info(f"File upload api started : {value}")
+        if dry_run:
+            report = await validate_upload_stream(db, file, value)
+            logger.info(f"file upload {value.value} dry run api run successfully")
+            return {
+                "status": "success",
+                "message": "No errors found" if report["valid"] else f"{report['error_count']} errors found",
+                "data": report
+            }
+
+        file_hash = await upload_file_hash(file)
+        if not force:
+            cached = await get_cached_upload(db, value, file_hash)
+            if cached:
+                logger.info(f"file upload {value.value} skipped, same file uploaded at {cached['uploaded_at']}")
+                return cached
+
+        if background:
+            job = await create_upload_job(file, value, current_user, delta=delta, file_hash=file_hash)
+            return {
+                "status": "success",
+                "message": "File upload job queued",
+                "data": job
+            }
+
+        if stream or is_compressed_upload(file.filename):
+            stats = await process_upload_stream(db, file, value, current_user, delta=delta)
+            logger.info(f"file upload {value.value} stream api run successfully")
+            response = {
+                "status": "success",
+                "message": UPLOAD_SUCCESS_MESSAGES[value],
+                "data": stats
+            }
+            await save_upload_history(db, value, file, file_hash, response, current_user)
+            return response
+
         rows = await read_csv_file(file)
         if value == FileUploadType.invoice: 
-            party_rows, invoice_rows, product_rows = await prepare_invoice_upload_data(db,rows,current_user)
+            party_rows, invoice_rows, product_rows, overridden_invoice_ids = await prepare_invoice_upload_data(db,rows,current_user)
             
-            await save_invoice_upload_data(db,party_rows, invoice_rows, product_rows)
+            await save_invoice_upload_data(db,party_rows, invoice_rows, product_rows, overridden_invoice_ids)
             logger.info("file upload invoice api run successfully")
-            return {
+            response = {
             "status" : "success",
             "message" : "Invoices data added successfully",
             }
         
-        if value == FileUploadType.party_master:
+        elif value == FileUploadType.party_master:
             prepared_data_party_master = await prepare_party_master_data(db,rows,current_user)
             await save_party_master_data(db,prepared_data_party_master)
             logger.info("file upload party master api run successfully")
-            return {
+            response = {
             "status" : "success",
             "message" : "Party Master data added successfully",
             }
         
-        if value == FileUploadType.product_master:
+        elif value == FileUploadType.product_master:
             # await check_duplicate_csv_product_master(rows)
             records = await prepare_product_master_data(rows,current_user)
-            message = await save_product_master_data(db,records)
-            return {
+            message = await save_product_master_data(db,records,delta=delta)
+            response = {
             "status" : "success",
             **message
             }
         
-        if value == FileUploadType.rack_master:
+        elif value == FileUploadType.rack_master:
             await check_rack_no_rack_master(rows)
             # await check_duplicate_csv_rack_master(rows)
             prepared_rack_master = await prepare_rack_master_data(db, rows, current_user)
             message = await save_rack_master_data(db, prepared_rack_master)
             logger.info("file upload rack master api run successfully")
-            return {
+            response = {
                 "status": "success",
                 **message
             }
             
-        if value == FileUploadType.tray_master:
+        elif value == FileUploadType.tray_master:
             # await validate_tray_master_csv(db, rows)
             await check_tray_no_tray_master(db,rows)
             prepared = await prepare_tray_master_data(rows)
             message = await save_tray_master_data(db, prepared)
 
             logger.info("file upload tray master api run successfully")
-            return {
+            response = {
                 "status": "success",
                 **message
             }
-                
+
+        await save_upload_history(db, value, file, file_hash, response, current_user)
+        return response
         
     except HTTPException:
         raise
@@ -108,6 +167,50 @@ async def file_upload(db: AsyncSession = Depends(get_db),
     
     
 
+@router.post("/file_upload/bundle")
+async def file_upload_bundle(db: AsyncSession = Depends(get_db),
+                    files: list[UploadFile] = File(...),
+                    values: list[FileUploadType] = Form(...),
+                    current_user: User = Depends(get_current_user)):
+    """ Uploads several files in one request, values[i] being the FileUploadType of files[i] (one file per type).
+        Files are parsed concurrently and written party → product → rack → tray → invoice
+        in a single transaction, so the whole bundle is stored or nothing is."""
+    try:
+        logger.info(f"File upload bundle api started : {[value.value for value in values]}")
+        summary = await process_upload_bundle(db, files, values, current_user)
+        logger.info("file upload bundle api run successfully")
+        return {
+            "status": "success",
+            "message": "Bundle uploaded successfully",
+            "data": summary
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"file_upload_bundle api: {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
+@router.get("/file_upload/jobs/{job_id}")
+async def file_upload_job_status(job_id: str, current_user: User = Depends(get_current_user)):
+    """ Returns the progress of a background file upload job:
+        status, rows parsed, rows written, batches, throughput and errors."""
+    try:
+        job = get_upload_job(job_id)
+        return {
+            "status": "success",
+            "message": "Upload job fetched successfully",
+            "data": job
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"file_upload_job_status api: {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
 @router.get("/")
 async def invoices( type: FlowType,db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
@@ -119,18 +222,28 @@ async def invoices( type: FlowType,db: AsyncSession = Depends(get_db),
     is_verified: bool | None = Query(None, description="true = verified only, false = unverified only, none = unverified first then verified"),
 
     page: int = Query(1, ge=1),
-    page_size: int = Query(10, ge=1, le=100)
+    page_size: int = Query(10, ge=1, le=100),
+    pagination: PaginationMode = Query(PaginationMode.offset, description="offset = page numbers, cursor = next_cursor of the previous page"),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; implies pagination=cursor"),
+    include_total: bool = Query(True, description="cursor pagination only: false skips the total count")
     ):
     """Fetches paginated invoices for the authenticated user with search and filter support.
     Allows filtering by priority, verification status, and date range, along with flexible text search.
     Allows searching by invoice number or party code or party name
-    Returns total count, pagination info, and structured invoice data."""
+    Returns total count, pagination info, and structured invoice data.
+    With cursor pagination each page seeks past the previous one on an index instead of skipping rows,
+    and the total is optional and cached for INVOICES_COUNT_CACHE_SECONDS."""
     
     try:
         logger.info("Invoices get api started")
         base_query = list_invoices_base_query()
         
-        rows,total = await invoices_apply_filters_search_pagination(type,db,base_query,search,priority,from_date,to_date,is_verified,page,page_size)
+        keyset = bool(cursor) or pagination == PaginationMode.cursor
+        if keyset:
+            rows,total,next_cursor = await invoices_apply_filters_search_cursor(type,db,base_query,search,priority,from_date,to_date,is_verified,cursor,page_size,include_total)
+        else:
+            rows,total = await invoices_apply_filters_search_pagination(type,db,base_query,search,priority,from_date,to_date,is_verified,page,page_size)
+            next_cursor = None
         
         if not rows:
             logger.error("Invoices data not found")
@@ -142,18 +255,28 @@ async def invoices( type: FlowType,db: AsyncSession = Depends(get_db),
 
         invoice_map=invoices_return_structure(rows)
 
-        data= {
-            "page": page,
-            "page_size": page_size,
-            "total": total,
-            "invoices": list(invoice_map.values())
-        }
+        if keyset:
+            data= {
+                "page_size": page_size,
+                "total": total,
+                "next_cursor": next_cursor,
+                "invoices": list(invoice_map.values())
+            }
+        else:
+            data= {
+                "page": page,
+                "page_size": page_size,
+                "total": total,
+                "invoices": list(invoice_map.values())
+            }
         logger.info("Invoices get api runs successfully")
         return {
             "status" : "success",
             "message" : "Data fetched successfully",
             "data":data
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Invoices get api: {e}")
         raise HTTPException(status_code=400, detail={"status" : "error",
@@ -360,14 +483,18 @@ async def invoice_product_add_delete(invoice_id:str, type: FlowType,
             "message" : f"Invoice not found for invoice_id: {invoice_id}"})
             
             
+        # Re-uploading the invoice file must restore its lines; committed with the line change
+        await forget_uploads(db, FileUploadType.invoice)
         if data.action == "delete":
             await delete_invoice_product(db,data.product_id)
+            invalidate_invoice_matches([invoice_id])
             logger.info(f"Productid: {data.product_id} deleted from invoice_product_list")
             return {"status": "success", "message": "Product deleted successfully"}
         
         elif data.action == "add":
             # Check if already exists
             created = await add_invoice_product(db,invoice_id,data,type)
+            invalidate_invoice_matches([invoice_id])
             logger.info(f"Product added successfully to invoice: {invoice_id}")
             return {"status": "success", "message": f"Product added successfully to invoice: {invoice_id}",
                 "product":created}
@@ -412,7 +539,10 @@ async def invoice_delete(invoice_id:str, db: AsyncSession = Depends(get_db),
             logger.exception(f"Invoice : {invoice_id} deletion failed")
             raise HTTPException(status_code=400, detail={"status": "error", "message": f"Invoice : {invoice_id} deletion failed"})
         
+        # Re-uploading the invoice file must ingest it again
+        await forget_uploads(db, FileUploadType.invoice)
         await db.commit()
+        invalidate_invoice_matches([invoice_id])
         logger.info(f"Invoice & products deleted successfully for invoice: {invoice_id}")
         return {"status": "success", "message": "Invoice & products deleted successfully"}
             
@@ -14,15 +14,17 @@ import asyncio
 from src.models.auth import User
 
 #  ***************** services  Import  *******************
-from src.services.products import match_scan,scan_quantity_update_products,release_trays_if_completed, get_product_qty_converter_count, \
+from src.services.products import match_scan,match_scan_batch,scan_quantity_update_products,release_trays_if_completed, get_product_qty_converter_count, \
     get_product_qty_converter_data, product_qty_converter_exist, update_product_qty_converter_values
 from src.services.invoices import search_batch_number_invoice
+from src.services.product_catalog import scan_match_cache
+from src.services.scan_trace import scan_stage_metrics
 
 #  ***************** Helpers Import  *******************
 from src.helpers.invoices import check_invoice_exists,FlowType
 
 #  *****************   Schemas Import  *******************
-from src.schemas.products import MatchScanRequest, UpdateTrayInvoiceRequest, ProductScanUpdate,ProductScanQtyUpdate, \
+from src.schemas.products import MatchScanRequest, MatchScanBatchRequest, UpdateTrayInvoiceRequest, ProductScanUpdate,ProductScanQtyUpdate, \
     ProductQtyConverterListResponse, UpdateProductQtyConverterSchema
 
 
@@ -32,6 +34,7 @@ router = APIRouter(tags=["Products"])
 @router.post("/match/scan")
 async def match_scan_product(
                 data: MatchScanRequest,
+                debug: bool = Query(False, description="Include the per-stage timing trace of the search in the response"),
                 db: AsyncSession = Depends(get_db),
                 current_user: User = Depends(get_current_user),
                 ):
@@ -40,7 +43,8 @@ async def match_scan_product(
         Validates invoice existence and required search parameters before initiating the match process.
         Performs hierarchical search using direct batch match, fuzzy logic, and progressive filtering.
         Supports barcode-based direct lookup when available for high-accuracy matching.
-        Returns a list of matched products along with total count and match status. """
+        Returns a list of matched products along with total count and match status;
+        with debug=true also the wall time and candidate count of every search stage in "trace". """
     
     try:
         exists = await check_invoice_exists(db, data.invoice_id)
@@ -54,7 +58,7 @@ async def match_scan_product(
             raise HTTPException(status_code=400, detail={"status":"error", "message":"Not sufficient parameters to search products",
                                                         "data":[]})
         
-        result = await match_scan(db,data)
+        result = await match_scan(db,data,debug)
         return result
 
     except HTTPException:
@@ -64,6 +68,56 @@ async def match_scan_product(
                 "message" : str(e).split("\n")[0][:100], "data":[]})
         
         
+@router.post("/match/scan/batch")
+async def match_scan_products_batch(
+                data: MatchScanBatchRequest,
+                db: AsyncSession = Depends(get_db),
+                current_user: User = Depends(get_current_user),
+                ):
+    
+    """ Matches up to 100 queued scans in one request, each item taking the same fields as /match/scan.
+        Invoices are checked once and all batch numbers and barcodes are looked up with set-based queries
+        before the per-item hierarchical search.
+        Returns one /match/scan style result per item, in request order; a failing item does not fail the others. """
+    
+    try:
+        results = await match_scan_batch(db, data.items)
+        return {
+            "status": "success",
+            "count_of_items": len(results),
+            "count_of_items_matched": sum(result["status"] == "success" for result in results),
+            "message": f"Matched {len(results)} scans",
+            "data": results
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100], "data":[]})
+        
+        
+@router.get("/match/scan/cache")
+async def match_scan_cache_stats(current_user: User = Depends(get_current_user)):
+    """ Size, hit / miss counters and hit rate of the /match/scan response cache of this worker process. """
+    return {
+        "status": "success",
+        "message": "Match scan cache stats",
+        "data": scan_match_cache.stats()
+    }
+
+
+@router.get("/match/scan/metrics")
+async def match_scan_stage_metrics(current_user: User = Depends(get_current_user)):
+    """ Latency histograms per /match/scan search stage and counts of the deciding stage, for the scans
+        of this worker process traced while MATCH_SCAN_TRACE is enabled. """
+    return {
+        "status": "success",
+        "message": "Match scan stage metrics",
+        "data": scan_stage_metrics.stats()
+    }
+        
+        
 @router.get("/search/batch_no")
 async def get_products_batch_number(
             batch_number: str = Query(..., min_length=3, description="Enter at least 3 characters of batch number"),
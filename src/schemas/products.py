@@ -36,6 +36,10 @@ class MatchScanRequest(BaseModel):
         
         
 
+class MatchScanBatchRequest(BaseModel):
+    items: List[MatchScanRequest] = Field(..., min_length=1, max_length=100)
+
+
 class UpdateTrayInvoiceRequest(BaseModel):
     invoice_id: str | None  # can be null to remove the invoice
     
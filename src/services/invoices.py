@@ -1,21 +1,40 @@
 from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
 import csv
 import io
-from sqlalchemy import or_, text
+from sqlalchemy import bindparam, or_, text
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Dict
 from datetime import datetime
 import uuid
+import hashlib
+import asyncio
+import time
+from collections import OrderedDict
 from sqlalchemy import select
 from src.models.invoices import Invoice, InvoiceStatus
 from src.models.parties import PartyMaster
 from src.logger.logger_setup import logger
-from src.helpers.invoices import FlowType,parse_expiry_or_mfg_date, invoice_upload_date_format, epoch_to_str, invoices_metadata_field_map
+from src.helpers.invoices import FlowType,parse_expiry_or_mfg_date, invoice_upload_date_format, epoch_to_str, invoices_metadata_field_map, \
+    normalize_batch_key, encode_invoices_cursor, decode_invoices_cursor
+from src.helpers.date_codec import parse_dmy_hms
 from src.models.invoices import ScanStatusEnum
 import statistics
 from src.schemas.invoices import InvoiceMetadataUpdateSchema
+from src.services.product_index import product_rack_index, bump_data_version, PRODUCT_MASTER_VERSION
+from src.services.product_catalog import product_catalog, invalidate_invoice_matches
+from src.core.config import settings
+from src.core.process_pool import run_in_process_pool
 
 DATETIME_FORMAT = "%d-%m-%Y %H:%M:%S"
+IN_QUERY_CHUNK_SIZE = 500
+# Invoice lines are inserted this many per statement, so the event loop gets a turn between statements
+INVOICE_PRODUCT_INSERT_CHUNK_SIZE = 2000
+
+# Columns a product master upsert can change; item_code, batch_number, expiry_date and mrp are the row key
+PRODUCT_MASTER_FINGERPRINT_FIELDS = (
+    "mfg_date", "rack_no", "division", "obatch", "barcode1", "barcode2", "optional1", "optional2",
+)
 
 async def read_csv_file(file):
     try:
@@ -67,19 +86,25 @@ async def read_csv_file(file):
         
         
 
-async def delete_invoice_product_list(db,invoice_id):
+async def delete_invoice_product_list(db,invoice_ids):
+    """
+    Deletes the invoice_product_list rows of invoice_ids, one statement per IN_QUERY_CHUNK_SIZE invoices.
+    Does not commit; the caller owns the transaction.
+    """
     try:
-        delete_invoice_product_query = "DELETE FROM invoice_product_list WHERE invoice_id = :invoice_id"
-        
-        await db.execute(text(delete_invoice_product_query), {"invoice_id": invoice_id})
-        await db.commit()
+        for invoice_ids_chunk in chunked(list(invoice_ids), IN_QUERY_CHUNK_SIZE):
+            params = {}
+            in_filter = build_in_filter("invoice_id", invoice_ids_chunk, "invoice_id", params)
+            delete_invoice_product_query = f"DELETE FROM invoice_product_list WHERE {in_filter}"
+
+            await db.execute(text(delete_invoice_product_query), params)
     except Exception as e:
         logger.exception(f"delete_invoice_product_list {e}")
         raise HTTPException(status_code=400, detail={"status" : "error",
                 "message" : str(e).split("\n")[0][:100]})
     
 
-async def invoice_product_data_handling(db,product_rows_map,row,invoice_id,expiry_date):
+def invoice_product_data_handling(product_rows_map,row,invoice_id,expiry_date):
     try:
         mrp = round(float(row.get("mrp") or 0), 2)
         product_name = row.get("product_name").strip()
@@ -98,30 +123,8 @@ async def invoice_product_data_handling(db,product_rows_map,row,invoice_id,expir
             product_rows_map[product_key]["actual_qty"] += qty
             return None
 
-        # (2) Already exists in DB → stop import
-        existing_check = """
-            SELECT id FROM invoice_product_list
-            WHERE invoice_id = :invoice_id
-            AND product_name = :product_name
-            AND batch_number = :batch_number
-            AND expiry_date = :expiry_date
-            AND mrp = :mrp;
-        """
-
-        result = await db.execute(text(existing_check), {
-            "invoice_id": invoice_id,
-            "product_name": product_name,
-            "batch_number": batch_number,
-            "expiry_date": expiry_date,
-            "mrp": mrp
-        })
-
-        if result.fetchone():
-            logger.exception(f"Duplicate product exists in DB — ({invoice_id} | {row.get('batch_number')} | {mrp})")
-            raise HTTPException(status_code=400, detail={
-                "status": "error",
-                "message": f"Duplicate product exists in DB — ({invoice_id} | {row.get('batch_number')} | {mrp})"
-            })
+        # (2) Already exists in DB → cannot happen: an existing invoice is either overridden (its lines
+        # are deleted on save) or rejected in prepare_invoice_upload_data, every other invoice gets a new id
 
         # (3) New record → store
         product_data = {
@@ -140,48 +143,90 @@ async def invoice_product_data_handling(db,product_rows_map,row,invoice_id,expir
         product_rows_map[product_key] = product_data
         return product_data
     
-    except HTTPException:
-        raise
     except Exception as e:
         logger.exception(f"inside invoice_product_data_handling: {e}")
         raise HTTPException(status_code=400, detail={"status" : "error",
                 "message" : str(e).split("\n")[0][:100]})
 
 
-async def prepare_invoice_upload_data(db,rows,current_user):
+async def load_existing_parties(db, party_codes: set, upload_state: dict) -> dict:
+    """
+    Adds the party_master ids of party_codes not looked up yet to upload_state["existing_parties"],
+    one IN query per IN_QUERY_CHUNK_SIZE codes, and returns the party_code → id map.
+    """
+    existing_parties = upload_state.setdefault("existing_parties", {})
+    looked_up = upload_state.setdefault("looked_up_party_codes", set())
+    party_codes = [code for code in party_codes if code is not None and code not in looked_up]
+
+    for party_codes_chunk in chunked(party_codes, IN_QUERY_CHUNK_SIZE):
+        params = {}
+        in_filter = build_in_filter("party_code", party_codes_chunk, "party_code", params)
+        existing_parties_query = f"""
+            SELECT party_code, id
+            FROM party_master
+            WHERE {in_filter};
+        """
+        result = await db.execute(text(existing_parties_query), params)
+        for row in result.mappings().all():
+            existing_parties[row.party_code] = row.id
+    looked_up.update(party_codes)
+    return existing_parties
+
+
+async def load_existing_invoices(db, invoice_nos: set, upload_state: dict) -> dict:
+    """
+    Adds the invoices of invoice_nos not looked up yet to upload_state["existing_invoices"],
+    one IN query per IN_QUERY_CHUNK_SIZE numbers, and returns the invoice_no → invoice info map.
+    """
+    existing_invoices = upload_state.setdefault("existing_invoices", {})
+    looked_up = upload_state.setdefault("looked_up_invoice_nos", set())
+    invoice_nos = [invoice_no for invoice_no in invoice_nos if invoice_no is not None and invoice_no not in looked_up]
+
+    for invoice_nos_chunk in chunked(invoice_nos, IN_QUERY_CHUNK_SIZE):
+        params = {}
+        in_filter = build_in_filter("invoice_no", invoice_nos_chunk, "invoice_no", params)
+        existing_invoices_query = f"""
+            SELECT invoice_no, id, status,is_completed
+            FROM invoices
+            WHERE {in_filter};
+        """
+        result = await db.execute(text(existing_invoices_query), params)
+        for row in result.mappings().all():
+            existing_invoices[row.invoice_no] = {"id": row.id, "status": row.status,"is_completed":row.is_completed}
+    looked_up.update(invoice_nos)
+    return existing_invoices
+
+
+async def prepare_invoice_upload_data(db,rows,current_user,upload_state=None):
+    """
+    Builds party, invoice and invoice product rows for an invoice CSV, plus the ids of existing
+    not-started invoices the file overrides. Nothing is written here; save_invoice_upload_data
+    replaces the overridden invoices' lines in the same transaction as the insert.
+    upload_state carries the caches between calls when a file is prepared batch by batch,
+    so qty merging and invoice/party reuse work across batches.
+    """
     try:
-        party_cache = {}     
-        invoice_cache = {}
-        
+        if upload_state is None:
+            upload_state = {}
+        party_cache = upload_state.setdefault("party_cache", {})
+        invoice_cache = upload_state.setdefault("invoice_cache", {})
+        product_rows_map = upload_state.setdefault("product_rows_map", {})
+        overridden_invoice_ids = upload_state.setdefault("overridden_invoice_ids", set())
+
         party_rows = []
         invoice_rows = []
         product_rows = []
-        product_rows_map = {}
-        
-        # Preload existing parties & invoices 
+
+        # Look up only the parties & invoices referenced by this batch
         # existing_parties = await db.execute(select(PartyMaster.party_code, PartyMaster.id))
         # existing_parties = {code: pid for code, pid in existing_parties.all()}
-        # Load exisitng parties
-        existing_parties_query = """
-            SELECT party_code, id
-            FROM party_master;
-        """
-        result = await db.execute(text(existing_parties_query))
-        existing_parties = {row.party_code: row.id for row in result.mappings().all()}
-
+        existing_parties = await load_existing_parties(
+            db, {row.get("party_id") for row in rows}, upload_state)
 
         # existing_invoices = await db.execute(select(Invoice.invoice_no, Invoice.id, Invoice.status))
         # existing_invoices = {inv_no: {"id": iid, "status": status} for inv_no, iid, status in existing_invoices.all()}
-        # Load existing invoices
-        existing_invoices_query = """
-            SELECT invoice_no, id, status,is_completed
-            FROM invoices;
-        """
-        result = await db.execute(text(existing_invoices_query))
-        existing_invoices = {
-            row.invoice_no: {"id": row.id, "status": row.status,"is_completed":row.is_completed}
-            for row in result.mappings().all()
-        }
+        existing_invoices = await load_existing_invoices(
+            db, {row.get("invoice_no") for row in rows}, upload_state)
 
         for row in rows:
             party_code = row.get("party_id")
@@ -216,16 +261,18 @@ async def prepare_invoice_upload_data(db,rows,current_user):
             #     party_id = party_cache[party_code]
             
             
-            if invoice_no in existing_invoices:
+            if invoice_no in invoice_cache:
+                invoice_id = invoice_cache[invoice_no]
+            elif invoice_no in existing_invoices:
                 invoice_info = existing_invoices[invoice_no]
                 allowed_status = [None, "", "not_started"]
                 if invoice_info["status"] not in allowed_status or invoice_info["is_completed"] == True:
                     logger.error(f"Invoice {invoice_no} already {invoice_info['status']} is_completed:{invoice_info['is_completed']} — cannot override.")
                     raise HTTPException(status_code=400, detail={"status":"error","message":f"Invoice {invoice_no} already {invoice_info['status']} is_completed:{invoice_info['is_completed']} — cannot override."})
 
-                # If not checked → override
+                # If not checked → override, its lines are deleted on save
                 invoice_id = invoice_info["id"]
-                await delete_invoice_product_list(db,invoice_id)
+                overridden_invoice_ids.add(invoice_id)
                 invoice_rows.append({
                     "id": invoice_id,
                     "invoice_no": invoice_no,
@@ -240,8 +287,7 @@ async def prepare_invoice_upload_data(db,rows,current_user):
                     "started_at": datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
                     "updated_at": datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
                 })
-            elif invoice_no in invoice_cache:
-                invoice_id = invoice_cache[invoice_no]
+                invoice_cache[invoice_no]=invoice_id
             else:
                 
                 invoice_id = str(uuid.uuid4())
@@ -264,12 +310,12 @@ async def prepare_invoice_upload_data(db,rows,current_user):
             # else:
             #     invoice_id = invoice_cache[invoice_no]
             
-            product_data = await invoice_product_data_handling(db,product_rows_map,row,invoice_id,invoice_product_expiry_date)
+            product_data = invoice_product_data_handling(product_rows_map,row,invoice_id,invoice_product_expiry_date)
             if product_data:
                 product_rows.append(product_data)
                 
         logger.info("prepare_invoice_upload_data function run successfully")
-        return (party_rows, invoice_rows, product_rows)
+        return (party_rows, invoice_rows, product_rows, set(overridden_invoice_ids))
     except HTTPException:
         raise
     except Exception as e:
@@ -280,30 +326,11 @@ async def prepare_invoice_upload_data(db,rows,current_user):
 
 async def invoices_products_assign_rack_no(db,product_rows):
     try:
-        product_match_query = """
-                SELECT 
-                    product_name, batch_number, expiry_date, mrp, rack_no
-                FROM product_master
-            """
-        result = await db.execute(text(product_match_query))
-        product_master_map = {
-            (row.product_name.strip().lower(), 
-                row.batch_number.strip().lower() if row.batch_number else "", 
-                str(row.expiry_date), 
-                round(float(row.mrp or 0), 2)
-                ): row.rack_no or "0"
-            for row in result.mappings().all()
-        }
-
-        #  Assign rack_no to matching invoice products
+        #  Assign rack_no to matching invoice products from the in-process product master index
+        await product_rack_index.ensure_loaded(db)
         for pr in product_rows:
-            key = (
-                pr["product_name"].strip().lower(),
-                pr["batch_number"].strip().lower() if pr["batch_number"] else "",
-                str(pr["expiry_date"]),
-                round(float(pr["mrp"] or 0), 2)
-            )
-            pr["rack_no"] = product_master_map.get(key, "0")
+            pr["rack_no"] = product_rack_index.get_rack_no(
+                pr["product_name"], pr["batch_number"], pr["expiry_date"], pr["mrp"])
         return product_rows
     except Exception as e:
         logger.exception(f"in invoices_assign_rack_no function: {e}")
@@ -311,8 +338,17 @@ async def invoices_products_assign_rack_no(db,product_rows):
                 "message" : str(e).split("\n")[0][:100]})
 
 
-async def save_invoice_upload_data(db,party_rows, invoice_rows, product_rows):
+async def save_invoice_upload_data(db,party_rows, invoice_rows, product_rows, overridden_invoice_ids=None, commit=True):
+    """
+    Writes an invoice upload in one transaction: overridden invoices' lines are deleted in
+    batched statements, then parties, invoices and products are inserted and committed once.
+    Any failure rolls the whole upload back. commit=False leaves the commit to the caller, which must
+    also call invalidate_invoice_matches once it has committed.
+    """
     try:
+        if overridden_invoice_ids:
+            await delete_invoice_product_list(db, overridden_invoice_ids)
+
         if party_rows:
             await db.execute(
                 text("""
@@ -341,16 +377,19 @@ async def save_invoice_upload_data(db,party_rows, invoice_rows, product_rows):
 
         if product_rows:
             product_rows_add = await invoices_products_assign_rack_no(db,product_rows)
-            await db.execute(
-                text("""
-                    INSERT INTO invoice_product_list 
-                    (id, invoice_id, product_name, batch_number, expiry_date, mrp, actual_qty, picker_scanned_qty, checker_scanned_qty, rack_no)
-                    VALUES (:id, :invoice_id, :product_name, :batch_number, :expiry_date, :mrp, :actual_qty, :picker_scanned_qty, :checker_scanned_qty, :rack_no)
-                """), product_rows_add
-            )
-        await db.commit()
+            insert_query = text("""
+                INSERT INTO invoice_product_list 
+                (id, invoice_id, product_name, batch_number, expiry_date, mrp, actual_qty, picker_scanned_qty, checker_scanned_qty, rack_no)
+                VALUES (:id, :invoice_id, :product_name, :batch_number, :expiry_date, :mrp, :actual_qty, :picker_scanned_qty, :checker_scanned_qty, :rack_no)
+            """)
+            for product_rows_chunk in chunked(product_rows_add, INVOICE_PRODUCT_INSERT_CHUNK_SIZE):
+                await db.execute(insert_query, product_rows_chunk)
+        if commit:
+            await db.commit()
+            invalidate_invoice_matches({row["invoice_id"] for row in product_rows or ()} | set(overridden_invoice_ids or ()))
         logger.info("in save_invoice_upload_data function run successfully")
     except Exception as e:
+        await db.rollback()
         logger.exception(f"in save_invoice_upload_data function: {e}")
         raise HTTPException(status_code=400, detail={"status" : "error",
                 "message" : str(e).split("\n")[0][:100]})
@@ -411,9 +450,45 @@ def build_in_filter(field_name: str, values: tuple, param_prefix: str, params: d
         placeholders.append(f":{key}")
         params[key] = val
     return f"{field_name} IN ({','.join(placeholders)})"
+
+
+def chunked(values: list, size: int):
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
     
 
-async def invoices_apply_filters_search_pagination(type,db,base_query,search,priority, from_date, to_date, is_verified,page,page_size):
+class InvoiceCountCache:
+    """
+    TTL / LRU cache of the filtered invoice counts of GET /invoices/ cursor pages, keyed by the filtered
+    query and its parameters, so paging and refreshing do not count the whole filtered set every time.
+    Not cleared on writes: a count can lag by up to INVOICES_COUNT_CACHE_SECONDS.
+    Lives in this worker process only.
+    """
+
+    def __init__(self):
+        self.__entries = OrderedDict()
+
+    async def count(self, db: AsyncSession, query: str, params: dict) -> int:
+        key = (query, tuple(sorted(params.items())))
+        entry = self.__entries.get(key)
+        if entry and time.monotonic() - entry[1] < settings.INVOICES_COUNT_CACHE_SECONDS:
+            self.__entries.move_to_end(key)
+            return entry[0]
+        total_result = await db.execute(text(f"SELECT COUNT(*) AS total FROM ({query}) AS subquery"), params)
+        total = total_result.scalar_one()
+        if settings.INVOICES_COUNT_CACHE_SECONDS > 0:
+            self.__entries[key] = (total, time.monotonic())
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > settings.INVOICES_COUNT_CACHE_SIZE:
+                self.__entries.popitem(last=False)
+        return total
+
+
+invoice_counts = InvoiceCountCache()
+
+
+def invoices_list_filters(type, search, priority, from_date, to_date, is_verified):
+    """WHERE conditions and their parameters for the GET /invoices/ search and filters."""
     try:
         filters = []
         params = {}
@@ -437,7 +512,7 @@ async def invoices_apply_filters_search_pagination(type,db,base_query,search,pri
                 params["priority"] = priority_value
 
             except (ValueError, KeyError):
-                logger.error("in apply_filters_search_pagination function: Invalid priority value")
+                logger.error("in invoices_list_filters function: Invalid priority value")
                 raise HTTPException(status_code=400, detail={"status":"error","message":"Invalid priority value"})
             
         # Verified status logic
@@ -460,6 +535,34 @@ async def invoices_apply_filters_search_pagination(type,db,base_query,search,pri
             in_filter = build_in_filter("i.status", status_values, "unverified", params)
             filters.append(in_filter)
 
+        return filters,params
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"in invoices_list_filters function {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
+def invoices_list_sort_keys(type, is_verified) -> tuple:
+    """
+    (column, row field) pairs GET /invoices/ is ordered by: status group then priority, or priority alone
+    when filtered on is_verified. i.id comes last so the order is total and a cursor can resume after any
+    invoice. Every order is served by an index on the invoices sort key columns.
+    """
+    if is_verified is not None:
+        return (("i.priority_rank", "priority_rank"), ("i.id", "invoice_id"))
+    if type == FlowType.picker:
+        group = ("i.list_group_picker", "list_group_picker")
+    else:  # checker
+        group = ("i.list_group_checker", "list_group_checker")
+    return (group, ("i.priority_rank", "priority_rank"), ("i.id", "invoice_id"))
+
+
+async def invoices_apply_filters_search_pagination(type,db,base_query,search,priority, from_date, to_date, is_verified,page,page_size):
+    try:
+        filters,params = invoices_list_filters(type,search,priority,from_date,to_date,is_verified)
+
         query_with_filters = base_query
 
         if filters:
@@ -472,38 +575,8 @@ async def invoices_apply_filters_search_pagination(type,db,base_query,search,pri
             
         offset = (page - 1) * page_size
 
-        if is_verified is None:
-            if type == FlowType.picker:
-                group1_status = ("not_started", "picking_start", "checking_start", "checking_end")
-                group3_last = "picking_end"
-            else:  # checker
-                group1_status = ("not_started", "checking_start", "picking_start", "picking_end")
-                group3_last = "checking_end"
-                
-            query_with_filters += f"""
-                ORDER BY
-                CASE
-                    WHEN i.is_completed = 0 AND i.status IN {group1_status} THEN 1
-                    WHEN i.is_completed = 1 THEN 2
-                    WHEN i.is_completed = 0 AND i.status = '{group3_last}' THEN 3
-                    ELSE 4
-                END,
-                CASE i.priority
-                    WHEN 'HIGH' THEN 1
-                    WHEN 'MEDIUM' THEN 2
-                    WHEN 'LOW' THEN 3
-                END
-            """
-        else:
-            #  Verified-only OR Unverified-only → just sort by priority
-            query_with_filters += """
-                ORDER BY CASE i.priority
-                    WHEN 'HIGH' THEN 1
-                    WHEN 'MEDIUM' THEN 2
-                    WHEN 'LOW' THEN 3
-                END
-            """
-        
+        sort_keys = invoices_list_sort_keys(type, is_verified)
+        query_with_filters += " ORDER BY " + ", ".join(column for column, _ in sort_keys)
         query_with_filters += " LIMIT :limit OFFSET :offset"
         params["limit"] = page_size
         params["offset"] = offset
@@ -521,6 +594,53 @@ async def invoices_apply_filters_search_pagination(type,db,base_query,search,pri
                 "message" : str(e).split("\n")[0][:100]})
 
 
+async def invoices_apply_filters_search_cursor(type,db,base_query,search,priority, from_date, to_date, is_verified,cursor,page_size,include_total):
+    """
+    Keyset pagination of the invoices list: seeks past the sort key in the cursor with a row value
+    comparison on the list index instead of sorting and skipping OFFSET rows, and reads one row more than
+    page_size to know whether a next page exists. The total is counted only when asked for, through
+    invoice_counts. Returns (rows, total or None, next_cursor or None).
+    """
+    try:
+        filters,params = invoices_list_filters(type,search,priority,from_date,to_date,is_verified)
+
+        query_with_filters = base_query
+        if filters:
+            query_with_filters += " WHERE " + " AND ".join(filters)
+
+        total = await invoice_counts.count(db, query_with_filters, params) if include_total else None
+
+        sort_keys = invoices_list_sort_keys(type, is_verified)
+        columns = ", ".join(column for column, _ in sort_keys)
+        if cursor:
+            sort_key = decode_invoices_cursor(cursor, len(sort_keys))
+            placeholders = []
+            for idx, value in enumerate(sort_key):
+                params[f"cursor_{idx}"] = value
+                placeholders.append(f":cursor_{idx}")
+            query_with_filters += " AND " if filters else " WHERE "
+            query_with_filters += f"({columns}) > ({', '.join(placeholders)})"
+
+        query_with_filters += f" ORDER BY {columns} LIMIT :limit"
+        params["limit"] = page_size + 1
+
+        result = await db.execute(text(query_with_filters), params)
+        rows = result.mappings().all()
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_invoices_cursor([rows[-1][field] for _, field in sort_keys])
+        logger.info("invoices_apply_filters_search_cursor function runs successfully")
+        return (rows,total,next_cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"in invoices_apply_filters_search_cursor function {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
 async def paginate_query(
     db: AsyncSession,
     base_query: str,
@@ -625,7 +745,7 @@ async def prepare_party_master_data(db, rows,current_user):
         )
         
 
-async def save_party_master_data(db,values_list):
+async def save_party_master_data(db,values_list,commit=True):
     try:
         sql = """
         INSERT INTO party_master (
@@ -644,7 +764,8 @@ async def save_party_master_data(db,values_list):
         """
         
         await db.execute(text(sql), values_list)
-        await db.commit()
+        if commit:
+            await db.commit()
     except Exception as e:
         logger.exception(f"inside save_party_master_data: {e}")
         raise HTTPException(
@@ -653,37 +774,65 @@ async def save_party_master_data(db,values_list):
         )
         
         
-async def prepare_product_master_data(rows,current_user):
+def normalize_product_master_rows(rows, updated_by, now):
+    """
+    Turns product master CSV rows into product_master records.
+    Module-level and free of DB/session state so it can run in the process pool.
+    """
+    records = []
+    for row in rows:
+        expiry_date = parse_expiry_or_mfg_date(row.get("expiry_date", ""),"expiry")
+        mfg_date = parse_expiry_or_mfg_date(row.get("mfg_date", ""),"mfg")
+        rack_no = row.get("rack_no")
+        rack_no = rack_no.strip() if rack_no else "0"
+        record = {
+            "id":str(uuid.uuid4()),
+            "item_code":row["item_code"].strip(),
+            "product_name": row["product_name"].strip(),
+            "batch_number": row["batch_number"].strip(),
+            "batch_key": normalize_batch_key(row["batch_number"]),
+            # "expiry_date": row["expiry_date"].strip(),
+            # "mfg_date": row["mfg_date"].strip(),
+            "rack_no": rack_no,
+            "expiry_date": expiry_date,
+            "mfg_date": mfg_date,
+            "mrp": round(float(row.get("mrp") or 0), 2),
+            "division": row.get("division", "").strip(),
+            "obatch": row.get("obatch", ""),
+            "barcode1": row.get("barcode1", ""),
+            "barcode2": row.get("barcode2", ""),
+            "optional1": row.get("optional1", ""),
+            "optional2": row.get("optional2", ""),
+            "updated_by": updated_by,   # <-- from logged-in user
+            "created_at": now,
+            "updated_at": now
+        }
+        record["row_fingerprint"] = product_master_fingerprint(record)
+        records.append(record)
+    return records
+
+
+async def prepare_product_master_data(rows,current_user,offload=False):
+    """
+    Normalises product master rows. Files larger than UPLOAD_NORMALIZE_CHUNK_SIZE rows are split into
+    chunks and normalised in the process pool, so the event loop only awaits the results.
+    Otherwise offload=True (background jobs) normalises in a worker thread, which is no faster but
+    leaves the event loop free for scan requests in the meantime.
+    """
     try:
         now = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-        records = []
-        for row in rows:
-            expiry_date = parse_expiry_or_mfg_date(row.get("expiry_date", ""),"expiry")
-            mfg_date = parse_expiry_or_mfg_date(row.get("mfg_date", ""),"mfg")
-            rack_no = row.get("rack_no")
-            rack_no = rack_no.strip() if rack_no else "0"
-            records.append({
-                "id":str(uuid.uuid4()),
-                "item_code":row["item_code"].strip(),
-                "product_name": row["product_name"].strip(),
-                "batch_number": row["batch_number"].strip(),
-                # "expiry_date": row["expiry_date"].strip(),
-                # "mfg_date": row["mfg_date"].strip(),
-                "rack_no": rack_no,
-                "expiry_date": expiry_date,
-                "mfg_date": mfg_date,
-                "mrp": round(float(row.get("mrp") or 0), 2),
-                "division": row.get("division", "").strip(),
-                "obatch": row.get("obatch", ""),
-                "barcode1": row.get("barcode1", ""),
-                "barcode2": row.get("barcode2", ""),
-                "optional1": row.get("optional1", ""),
-                "optional2": row.get("optional2", ""),
-                "updated_by": current_user.id,   # <-- from logged-in user
-                "created_at": now,
-                "updated_at": now
-            })
-            
+        chunk_size = settings.UPLOAD_NORMALIZE_CHUNK_SIZE
+        if settings.UPLOAD_NORMALIZE_WORKERS <= 0 or len(rows) <= chunk_size:
+            if offload:
+                return await run_in_threadpool(normalize_product_master_rows, rows, current_user.id, now)
+            return normalize_product_master_rows(rows, current_user.id, now)
+
+        chunk_records = await asyncio.gather(*[
+            run_in_process_pool(normalize_product_master_rows, rows_chunk, current_user.id, now)
+            for rows_chunk in chunked(rows, chunk_size)
+        ])
+        records = [record for chunk in chunk_records for record in chunk]
+        logger.info(f"prepare_product_master_data: {len(records)} rows normalised in the process pool")
         return records
     except Exception as e:
         logger.exception(f"inside prepare_product_master_data: {e}")
@@ -693,21 +842,78 @@ async def prepare_product_master_data(rows,current_user):
         )
         
         
-async def save_product_master_data(db,records):
+def product_master_fingerprint(record: dict) -> str:
+    values = "\x1f".join(str(record.get(field) or "") for field in PRODUCT_MASTER_FINGERPRINT_FIELDS)
+    return hashlib.blake2b(values.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def split_product_master_delta(db, records):
+    """
+    Compares records with the stored row_fingerprint of the same (item_code, batch_number, expiry_date, mrp)
+    and returns (inserted, updated, unchanged) record lists. Rows stored before fingerprints existed count
+    as updated once. When a key repeats in the file the last row wins, as with the upsert.
+    """
+    # prepare_product_master_data already rounds mrp
+    latest = {
+        (record["item_code"], record["batch_number"], record["expiry_date"], record["mrp"]): record
+        for record in records
+    }
+
+    # One statement for every chunk; an expanding bind param keeps it from being re-parsed per chunk
+    stored_query = text("""
+        SELECT item_code, batch_number, expiry_date, mrp, row_fingerprint
+        FROM product_master
+        WHERE item_code IN :item_codes
+    """).bindparams(bindparam("item_codes", expanding=True))
+    stored = {}
+    item_codes = list({key[0] for key in latest})
+    for item_codes_chunk in chunked(item_codes, IN_QUERY_CHUNK_SIZE):
+        result = await db.execute(stored_query, {"item_codes": item_codes_chunk})
+        for item_code, batch_number, expiry_date, mrp, row_fingerprint in result.all():
+            stored[(item_code, batch_number, expiry_date, round(mrp or 0, 2))] = row_fingerprint
+
+    inserted, updated, unchanged = [], [], []
+    for key, record in latest.items():
+        if key not in stored:
+            inserted.append(record)
+        elif stored[key] != record["row_fingerprint"]:
+            updated.append(record)
+        else:
+            unchanged.append(record)
+    return inserted, updated, unchanged
+
+
+async def save_product_master_data(db,records,delta=False,commit=True):
+    """
+    Upserts product master records. With delta=True only rows that are new or whose
+    fingerprinted columns changed are written, and inserted/updated/unchanged counts are returned.
+    commit=False leaves the transaction to the caller (bundle uploads); the rack index is still
+    refreshed from this session, so the caller must invalidate it if it rolls back, and call
+    invalidate_invoice_matches once it has committed.
+    """
     try:
+        if delta:
+            inserted, updated, unchanged = await split_product_master_delta(db, records)
+            counts = {"inserted": len(inserted), "updated": len(updated), "unchanged": len(unchanged)}
+            records = inserted + updated
+            if not records:
+                logger.info(f"Delta upload completed — nothing to write, {counts}")
+                return {"message": "0 products processed successfully", "data": counts}
+
         insert_query = text("""
             INSERT INTO product_master (
-                id, item_code, product_name, batch_number, expiry_date, mfg_date,
+                id, item_code, product_name, batch_number, batch_key, expiry_date, mfg_date,
                 rack_no, mrp, division, obatch, barcode1, barcode2, optional1, optional2,
-                updated_by, created_at, updated_at
+                row_fingerprint, updated_by, created_at, updated_at
             )
             VALUES (
-                :id, :item_code, :product_name, :batch_number, :expiry_date, :mfg_date,
+                :id, :item_code, :product_name, :batch_number, :batch_key, :expiry_date, :mfg_date,
                 :rack_no, :mrp, :division, :obatch, :barcode1, :barcode2, :optional1, :optional2,
-                :updated_by, :created_at, :updated_at
+                :row_fingerprint, :updated_by, :created_at, :updated_at
             )
             ON CONFLICT(item_code, batch_number, expiry_date, mrp)
             DO UPDATE SET
+                batch_key = excluded.batch_key,
                 mfg_date = excluded.mfg_date,
                 rack_no = excluded.rack_no,
                 division = excluded.division,
@@ -716,15 +922,24 @@ async def save_product_master_data(db,records):
                 barcode2 = excluded.barcode2,
                 optional1 = excluded.optional1,
                 optional2 = excluded.optional2,
+                row_fingerprint = excluded.row_fingerprint,
                 updated_by = excluded.updated_by,
                 updated_at = excluded.updated_at;
         """)
 
         await db.execute(insert_query, records)
-        await db.commit()
+        version = await bump_data_version(db, PRODUCT_MASTER_VERSION)
+        if commit:
+            await db.commit()
+        await product_rack_index.refresh_items(db, records, version)
+        await product_catalog.refresh_items(db, records, version)
+        if commit:
+            invalidate_invoice_matches()
 
         logger.info(f"Bulk upload completed — total {len(records)} processed")
         
+        if delta:
+            return {"message": f"{len(records)} products processed successfully", "data": counts}
         return {"message": f"{len(records)} products processed successfully"}
     
     except Exception as e:
@@ -736,11 +951,11 @@ async def save_product_master_data(db,records):
         
         
 # async def check_duplicate_csv_rack_master(rows: list[dict]):
-async def check_rack_no_rack_master(rows: list[dict]):
+async def check_rack_no_rack_master(rows: list[dict], start: int = 1):
     try:
         # rack_numbers = set()
 
-        for i, row in enumerate(rows, start=1):
+        for i, row in enumerate(rows, start=start):
             rack_no = (row.get("rack_no") or "").strip()
 
             # Check if rack_no is missing
@@ -800,7 +1015,7 @@ async def prepare_rack_master_data(db, rows, current_user):
             detail={"status": "error", "message": str(e).split('\n')[0][:100]}
         )
         
-async def save_rack_master_data(db, records):
+async def save_rack_master_data(db, records, commit=True):
     try:
         if not records:
             logger.warning("No records to insert in rack_master")
@@ -814,7 +1029,8 @@ async def save_rack_master_data(db, records):
                 user_assigned = EXCLUDED.user_assigned,
                 updated_at = EXCLUDED.updated_at;
         """), records)
-        await db.commit()
+        if commit:
+            await db.commit()
 
         logger.info("Rack master data inserted/updated successfully.")
         return {"message": "Rack master data inserted/updated successfully."}
@@ -1060,13 +1276,13 @@ async def add_transactions(data,db,current_user):
         
         
 # async def validate_tray_master_csv(db: AsyncSession, rows: list[dict]):
-async def check_tray_no_tray_master(db: AsyncSession, rows: list[dict]):
+async def check_tray_no_tray_master(db: AsyncSession, rows: list[dict], start: int = 1):
     try:
         # tray_nos = []
         # duplicate_csv = []
 
         # ---------------- CSV Validations ----------------
-        for index, row in enumerate(rows, start=1):
+        for index, row in enumerate(rows, start=start):
             tray_no = (row.get("tray_no") or "").strip()
 
             # tray_no must exist
@@ -1135,7 +1351,7 @@ async def prepare_tray_master_data(rows: list[dict]):
                 "message" : str(e).split("\n")[0][:100], "data":[]})
         
         
-async def save_tray_master_data(db: AsyncSession, tray_data: list[dict]):
+async def save_tray_master_data(db: AsyncSession, tray_data: list[dict], commit=True):
     try:
         if not tray_data:
             logger.info("No tray data to insert")
@@ -1148,9 +1364,8 @@ async def save_tray_master_data(db: AsyncSession, tray_data: list[dict]):
             ON CONFLICT (tray_no) DO UPDATE SET
                 tray_qr_value = EXCLUDED.tray_qr_value;
         """), tray_data)
-        await db.commit()
-
-        await db.commit()
+        if commit:
+            await db.commit()
         
         return {
             "message": f"{len(tray_data)} tray records inserted successfully"
@@ -1284,8 +1499,8 @@ def calculate_seconds_diff(start_str: str, end_str: str) -> int:
     """
     Converts 'DD-MM-YYYY HH:MM:SS' → seconds difference
     """
-    start_dt = datetime.strptime(start_str, DATETIME_FORMAT)
-    end_dt = datetime.strptime(end_str, DATETIME_FORMAT)
+    start_dt = parse_dmy_hms(start_str)
+    end_dt = parse_dmy_hms(end_str)
     return int((end_dt - start_dt).total_seconds())
 
 
@@ -1299,7 +1514,7 @@ def calculate_median_time_between_scans(timestamps: list[str]) -> float | None:
 
     # Convert to datetime objects
     dt_list = [
-        datetime.strptime(ts, DATETIME_FORMAT)
+        parse_dmy_hms(ts)
         for ts in timestamps
     ]
 
@@ -1431,7 +1646,7 @@ def ddmmyyyy_to_ymd_hms(date_str: str) -> str:
     if not date_str:
         return None
     # Parse the input string
-    dt_obj = datetime.strptime(date_str, "%d-%m-%Y %H:%M:%S")
+    dt_obj = parse_dmy_hms(date_str)
     # Format as YYYY-MM-DD HH:MM:SS
     return dt_obj.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -0,0 +1,393 @@
+from rapidfuzz.utils import default_process
+from sqlalchemy import text
+from src.core.config import settings
+from src.helpers.invoices import normalize_batch_key
+from src.logger.logger_setup import logger
+from src.services.product_index import get_data_version, PRODUCT_MASTER_VERSION
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+import asyncio
+import time
+
+ITEM_CODE_CHUNK_SIZE = 500
+
+# Columns returned to the scanner, in the order Finder selects them
+PRODUCT_COLUMNS = (
+    "id", "item_code", "product_name", "batch_number", "expiry_date", "mfg_date", "mrp", "division", "obatch",
+    "barcode1", "barcode2", "optional1", "optional2",
+)
+
+PRODUCT_SELECT = f"SELECT rowid, {', '.join(PRODUCT_COLUMNS)} FROM product_master"
+
+# Position of the lookup columns inside a stored row (rowid first, then PRODUCT_COLUMNS)
+ROWID, BATCH, EXPIRY, MFG, MRP, BARCODE1, BARCODE2 = 0, 4, 5, 6, 7, 10, 11
+
+
+# Character n-grams of batch numbers used to narrow fuzzy batch candidates before rapidfuzz scoring
+BATCH_NGRAM_SIZE = 3
+# WRatio's partial and token matching can score short batches >= BATCH_NGRAM_MIN_SCORE without a shared
+# n-gram, so shorter scanned batches are scored against every candidate and shorter batches are always candidates
+BATCH_NGRAM_MIN_LENGTH = 6
+# Lowest rapidfuzz score whose batches are sure to share an n-gram with the scanned batch
+BATCH_NGRAM_MIN_SCORE = 80
+
+
+def batch_ngrams(batch_number) -> set:
+    """
+    Padded character n-grams of a batch number after rapidfuzz's default_process, per token, so a
+    batch only loses the n-grams around a typo and reordered tokens still share theirs.
+    """
+    grams = set()
+    for token in default_process(str(batch_number)).split():
+        token = f"${token}$"
+        grams.update(token[i:i + BATCH_NGRAM_SIZE] for i in range(max(len(token) - BATCH_NGRAM_SIZE + 1, 1)))
+    return grams
+
+
+def _mrp_key(mrp) -> float:
+    # Non numeric MRPs never fall inside an MRP range, like in SQL
+    return mrp if isinstance(mrp, (int, float)) else float("-inf")
+
+
+class ProductCatalog:
+    """
+    In-process copy of product_master for /products/match/scan (PRODUCT_MATCH_IN_MEMORY=true).
+    Rows are kept as tuples and indexed by batch number, batch key, barcode1 / barcode2 and by expiry / mfg date
+    buckets sorted on (mrp, rowid), so every Finder lookup is a dict lookup plus a bisect on MRP.
+    Bucket order follows the order SQLite returns the same rows in through the product_master indexes,
+    which keeps the fuzzy batch ranking identical to the DB Finder.
+    Built on first use and kept current by refresh_items after every product master save;
+    it lives in this worker process only, so ensure_loaded reloads it when the data_versions counter
+    of product_master no longer matches version, i.e. another worker saved product master data.
+    """
+
+    def __init__(self):
+        self.__rows = {}
+        self.__by_batch = {}
+        self.__by_batch_key = {}
+        self.__by_barcode1 = {}
+        self.__by_barcode2 = {}
+        self.__by_expiry = {}
+        self.__by_mfg = {}
+        self.__by_ngram = {}
+        self.__short_batches = set()
+        self.__batches = set()
+        self.__loaded = False
+        self.__version = 0
+        self.__lock = asyncio.Lock()
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def loaded(self) -> bool:
+        return self.__loaded
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+    def __indexes(self, row):
+        """(index, key, entry) for every index a row belongs to."""
+        rowid, mrp = row[ROWID], _mrp_key(row[MRP])
+        yield self.__by_batch, row[BATCH], rowid
+        yield self.__by_batch_key, normalize_batch_key(row[BATCH]), rowid
+        if row[BARCODE1]:
+            yield self.__by_barcode1, row[BARCODE1], rowid
+        if row[BARCODE2]:
+            yield self.__by_barcode2, row[BARCODE2], rowid
+        yield self.__by_expiry, row[EXPIRY], (mrp, rowid)
+        if row[MFG]:
+            yield self.__by_mfg, row[MFG], (mrp, rowid)
+
+    def __store(self, rows):
+        for row in rows:
+            row = tuple(row)
+            old = self.__rows.get(row[ROWID])
+            if old == row:
+                continue
+            if old:
+                for index, key, entry in self.__indexes(old):
+                    bucket = index[key]
+                    del bucket[bisect_left(bucket, entry)]
+                    if not bucket:
+                        del index[key]
+            self.__rows[row[ROWID]] = row
+            for index, key, entry in self.__indexes(row):
+                insort(index.setdefault(key, []), entry)
+            self.__add_batch(row[BATCH])
+
+    def __add_batch(self, batch_number):
+        # Batch numbers are never removed: an upload cannot change or delete a row's batch_number
+        if not batch_number or batch_number in self.__batches:
+            return
+        self.__batches.add(batch_number)
+        if len(default_process(str(batch_number))) < BATCH_NGRAM_MIN_LENGTH:
+            self.__short_batches.add(batch_number)
+        for gram in batch_ngrams(batch_number):
+            self.__by_ngram.setdefault(gram, set()).add(batch_number)
+
+    async def ensure_loaded(self, db):
+        version = await get_data_version(db, PRODUCT_MASTER_VERSION)
+        if self.__loaded and self.__version == version:
+            return
+        async with self.__lock:
+            if self.__loaded and self.__version == version:
+                return
+            reload = self.__loaded
+            # Read before the rows, so a save committed in between only costs another reload
+            version = await get_data_version(db, PRODUCT_MASTER_VERSION)
+            result = await db.execute(text(PRODUCT_SELECT))
+            self.load_rows(result.all(), version)
+            if reload:
+                # Scans answered from the previous rows are stale in this worker too
+                invalidate_invoice_matches()
+            logger.info(f"ProductCatalog loaded {len(self.__rows)} products (version {self.__version})")
+
+    def load_rows(self, rows, version=0):
+        """Replaces the catalog with rows of (rowid, *PRODUCT_COLUMNS) read at the given version."""
+        self.__rows = {}
+        self.__by_batch, self.__by_batch_key, self.__by_barcode1, self.__by_barcode2 = {}, {}, {}, {}
+        self.__by_expiry, self.__by_mfg = {}, {}
+        self.__by_ngram, self.__short_batches, self.__batches = {}, set(), set()
+        for row in rows:
+            row = tuple(row)
+            self.__rows[row[ROWID]] = row
+            for index, key, entry in self.__indexes(row):
+                index.setdefault(key, []).append(entry)
+            self.__add_batch(row[BATCH])
+        for index in (self.__by_batch, self.__by_batch_key, self.__by_barcode1, self.__by_barcode2, self.__by_expiry, self.__by_mfg):
+            for bucket in index.values():
+                bucket.sort()
+        self.__loaded = True
+        self.__version = version
+
+    async def refresh_items(self, db, records, version):
+        """
+        Re-reads the product_master rows of the saved item codes and updates them in place.
+        version is what bump_data_version returned for the save; if other saves came in
+        between, the catalog is left behind for ensure_loaded to reload.
+        """
+        if not self.__loaded or not records:
+            return
+        if version != self.__version + 1:
+            return
+        item_codes = list({record["item_code"] for record in records})
+        for index in range(0, len(item_codes), ITEM_CODE_CHUNK_SIZE):
+            item_codes_chunk = item_codes[index:index + ITEM_CODE_CHUNK_SIZE]
+            placeholders = ", ".join([f":item_code{i}" for i in range(len(item_codes_chunk))])
+            params = {f"item_code{i}": code for i, code in enumerate(item_codes_chunk)}
+            result = await db.execute(text(f"{PRODUCT_SELECT} WHERE item_code IN ({placeholders})"), params)
+            self.__store(result.all())
+        self.__version = version
+        logger.debug(f"ProductCatalog refreshed {len(item_codes)} item codes (version {self.__version})")
+
+    def invalidate(self):
+        self.__rows = {}
+        self.__by_batch, self.__by_batch_key, self.__by_barcode1, self.__by_barcode2 = {}, {}, {}, {}
+        self.__by_expiry, self.__by_mfg = {}, {}
+        self.__by_ngram, self.__short_batches, self.__batches = {}, set(), set()
+        self.__loaded = False
+
+    def __products(self, rowids) -> list[dict]:
+        return [dict(zip(PRODUCT_COLUMNS, self.__rows[rowid][1:])) for rowid in rowids]
+
+    # Lookups below mirror the Finder queries; call ensure_loaded first.
+
+    def find_by_batch(self, batch_number) -> list[dict]:
+        return self.__products(self.__by_batch.get(batch_number, ()))
+
+    def find_by_batch_key(self, batch_key) -> list[dict]:
+        return self.__products(self.__by_batch_key.get(batch_key, ()))
+
+    def find_by_barcode(self, barcode) -> list[dict]:
+        """barcode1 matches first, then barcode2 matches not already returned (SQLite MULTI-INDEX OR order)."""
+        rowids = list(self.__by_barcode1.get(barcode, ()))
+        seen = set(rowids)
+        rowids += [rowid for rowid in self.__by_barcode2.get(barcode, ()) if rowid not in seen]
+        return self.__products(rowids)
+
+    def batch_candidates(self, batch_number) -> set | None:
+        """
+        Batch numbers sharing at least one n-gram with batch_number plus every short batch, a superset of the
+        batches rapidfuzz scores >= BATCH_NGRAM_MIN_SCORE against it. None when batch_number is too short to narrow on.
+        """
+        if len(default_process(str(batch_number))) < BATCH_NGRAM_MIN_LENGTH:
+            return None
+        postings = [self.__by_ngram.get(gram, ()) for gram in batch_ngrams(batch_number)]
+        return self.__short_batches.union(*postings)
+
+    def find_by_dates_mrp(self, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None,
+                          batch_numbers=None) -> list[dict]:
+        """Rows matching every given condition, ordered by (mrp, rowid)."""
+        buckets = []
+        if expiry_date is not None:
+            buckets.append((EXPIRY, self.__by_expiry.get(expiry_date, [])))
+        if mfg_date is not None:
+            buckets.append((MFG, self.__by_mfg.get(mfg_date, [])))
+        if not buckets:
+            return []
+
+        # Walk the smaller date bucket and check the other date on the row itself
+        column, bucket = min(buckets, key=lambda item: len(item[1]))
+        if min_mrp is not None:
+            bucket = bucket[bisect_left(bucket, (min_mrp,)):bisect_right(bucket, (max_mrp, float("inf")))]
+
+        rows = (self.__rows[rowid] for _, rowid in bucket)
+        if expiry_date is not None and column != EXPIRY:
+            rows = (row for row in rows if row[EXPIRY] == expiry_date)
+        if mfg_date is not None and column != MFG:
+            rows = (row for row in rows if row[MFG] == mfg_date)
+        if batch_numbers is not None:
+            batch_numbers = set(batch_numbers)
+            rows = (row for row in rows if row[BATCH] in batch_numbers)
+        return [dict(zip(PRODUCT_COLUMNS, row[1:])) for row in rows]
+
+
+product_catalog = ProductCatalog()
+
+
+INVOICE_PRODUCT_SELECT = f"""
+    SELECT DISTINCT pm.rowid, {', '.join(f'pm.{column}' for column in PRODUCT_COLUMNS)}
+    FROM invoice_product_list ip
+    JOIN product_master pm
+        ON ip.product_name = pm.product_name
+        AND ip.batch_number = pm.batch_number
+        AND ip.expiry_date = pm.expiry_date
+        AND ip.mrp = pm.mrp
+    WHERE ip.invoice_id = :invoice_id
+"""
+
+
+class InvoiceCatalogCache:
+    """
+    Small per-invoice ProductCatalogs holding the product_master rows of an invoice's own lines,
+    the first tier match_scan searches while that invoice is being verified.
+    Entries expire after PRODUCT_MATCH_INVOICE_CACHE_SECONDS and the least recently used invoice is
+    dropped beyond PRODUCT_MATCH_INVOICE_CACHE_SIZE; writes to an invoice's lines invalidate it.
+    A catalog read while an invalidation happened is returned but not stored.
+    """
+
+    def __init__(self):
+        self.__catalogs = OrderedDict()
+        self.__locks = {}
+        self.__generation = 0
+
+    def __len__(self) -> int:
+        return len(self.__catalogs)
+
+    async def get(self, db, invoice_id) -> ProductCatalog:
+        entry = self.__catalogs.get(invoice_id)
+        if entry and time.monotonic() - entry[1] < settings.PRODUCT_MATCH_INVOICE_CACHE_SECONDS:
+            self.__catalogs.move_to_end(invoice_id)
+            return entry[0]
+
+        lock = self.__locks.setdefault(invoice_id, asyncio.Lock())
+        async with lock:
+            entry = self.__catalogs.get(invoice_id)
+            if entry and time.monotonic() - entry[1] < settings.PRODUCT_MATCH_INVOICE_CACHE_SECONDS:
+                return entry[0]
+            generation = self.__generation
+            result = await db.execute(text(INVOICE_PRODUCT_SELECT), {"invoice_id": invoice_id})
+            catalog = ProductCatalog()
+            catalog.load_rows(result.all())
+            self.__locks.pop(invoice_id, None)
+            if generation != self.__generation:
+                return catalog
+            self.__catalogs[invoice_id] = (catalog, time.monotonic())
+            self.__catalogs.move_to_end(invoice_id)
+            while len(self.__catalogs) > settings.PRODUCT_MATCH_INVOICE_CACHE_SIZE:
+                self.__catalogs.popitem(last=False)
+            logger.debug(f"InvoiceCatalogCache loaded {len(catalog)} products for invoice {invoice_id}")
+            return catalog
+
+    def invalidate(self, invoice_ids=None):
+        """Drops the given invoices, or every invoice when invoice_ids is None."""
+        self.__generation += 1
+        if invoice_ids is None:
+            self.__catalogs.clear()
+            return
+        for invoice_id in invoice_ids:
+            self.__catalogs.pop(invoice_id, None)
+
+
+invoice_catalogs = InvoiceCatalogCache()
+
+
+class ScanMatchCache:
+    """
+    LRU / TTL cache of match_scan responses keyed by the cleaned scan tuple, so repeated scans of the
+    same line item skip the Finder cascade. Cleared when product master data is saved, per invoice when
+    an invoice's lines change. A response computed while an invalidation happened is not stored.
+    """
+
+    def __init__(self):
+        self.__entries = OrderedDict()
+        self.__generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        return self.__generation
+
+    @staticmethod
+    def make_key(invoice_id, batch_number, expiry_date, mrp, mfg_date, barcode1, barcode2) -> tuple:
+        return (invoice_id, batch_number, expiry_date, float(mrp or 0), mfg_date or "", barcode1 or "", barcode2 or "")
+
+    def get(self, key):
+        if settings.MATCH_SCAN_CACHE_SIZE <= 0:
+            return None
+        entry = self.__entries.get(key)
+        if entry and time.monotonic() - entry[1] < settings.MATCH_SCAN_CACHE_SECONDS:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry:
+            del self.__entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, response, generation: int):
+        if settings.MATCH_SCAN_CACHE_SIZE <= 0 or generation != self.__generation:
+            return
+        self.__entries[key] = (response, time.monotonic())
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > settings.MATCH_SCAN_CACHE_SIZE:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, invoice_ids=None):
+        """Drops the scans of the given invoices, or every scan when invoice_ids is None."""
+        self.__generation += 1
+        self.invalidations += 1
+        if invoice_ids is None:
+            self.__entries.clear()
+            return
+        invoice_ids = set(invoice_ids)
+        for key in [key for key in self.__entries if key[0] in invoice_ids]:
+            del self.__entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "max_size": settings.MATCH_SCAN_CACHE_SIZE,
+            "ttl_seconds": settings.MATCH_SCAN_CACHE_SECONDS,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+scan_match_cache = ScanMatchCache()
+
+
+def invalidate_invoice_matches(invoice_ids=None):
+    """Call after an invoice's lines change (invoice_ids) or after product master data changes (None)."""
+    invoice_catalogs.invalidate(invoice_ids)
+    scan_match_cache.invalidate(invoice_ids)
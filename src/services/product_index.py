@@ -0,0 +1,114 @@
+from sqlalchemy import text
+from src.logger.logger_setup import logger
+import asyncio
+
+ITEM_CODE_CHUNK_SIZE = 500
+PRODUCT_MASTER_VERSION = "product_master"
+
+
+async def get_data_version(db, name) -> int:
+    result = await db.execute(text("SELECT version FROM data_versions WHERE name = :name"), {"name": name})
+    return result.scalar() or 0
+
+
+async def bump_data_version(db, name) -> int:
+    """Counts a write to the named table in the caller's transaction and returns the new version."""
+    result = await db.execute(text("""
+        INSERT INTO data_versions (name, version) VALUES (:name, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+        RETURNING version
+    """), {"name": name})
+    return result.scalar_one()
+
+
+class ProductRackIndex:
+    """
+    In-process map of product_master (product_name, batch_number, expiry_date, mrp) → rack_no.
+    Built from the DB on first use, then kept current by refresh_items after every
+    product master save, so rack lookups for invoice lines are dictionary lookups.
+    The index lives in this worker process only; version is the data_versions counter of
+    product_master it was built at, and ensure_loaded reloads it once another worker's save
+    has moved the counter on.
+    """
+
+    def __init__(self):
+        self.__racks = {}
+        self.__loaded = False
+        self.__version = 0
+        self.__lock = asyncio.Lock()
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def loaded(self) -> bool:
+        return self.__loaded
+
+    @staticmethod
+    def make_key(product_name, batch_number, expiry_date, mrp) -> tuple:
+        return (
+            (product_name or "").strip().lower(),
+            batch_number.strip().lower() if batch_number else "",
+            str(expiry_date),
+            round(float(mrp or 0), 2)
+        )
+
+    def __store(self, rows):
+        for row in rows:
+            key = self.make_key(row.product_name, row.batch_number, row.expiry_date, row.mrp)
+            self.__racks[key] = row.rack_no or "0"
+
+    async def ensure_loaded(self, db):
+        version = await get_data_version(db, PRODUCT_MASTER_VERSION)
+        if self.__loaded and self.__version == version:
+            return
+        async with self.__lock:
+            if self.__loaded and self.__version == version:
+                return
+            # Read before the rows, so a save committed in between only costs another reload
+            version = await get_data_version(db, PRODUCT_MASTER_VERSION)
+            result = await db.execute(text("""
+                SELECT product_name, batch_number, expiry_date, mrp, rack_no
+                FROM product_master
+            """))
+            self.__racks = {}
+            self.__store(result.mappings().all())
+            self.__loaded = True
+            self.__version = version
+            logger.info(f"ProductRackIndex loaded {len(self.__racks)} products (version {self.__version})")
+
+    async def refresh_items(self, db, records, version):
+        """
+        Re-reads the product_master rows of the saved item codes and updates their keys.
+        version is what bump_data_version returned for the save; if other saves came in
+        between, the index is left behind for ensure_loaded to reload.
+        """
+        if not self.__loaded or not records:
+            return
+        if version != self.__version + 1:
+            return
+        item_codes = list({record["item_code"] for record in records})
+        for index in range(0, len(item_codes), ITEM_CODE_CHUNK_SIZE):
+            item_codes_chunk = item_codes[index:index + ITEM_CODE_CHUNK_SIZE]
+            placeholders = ", ".join([f":item_code{i}" for i in range(len(item_codes_chunk))])
+            params = {f"item_code{i}": code for i, code in enumerate(item_codes_chunk)}
+            result = await db.execute(text(f"""
+                SELECT product_name, batch_number, expiry_date, mrp, rack_no
+                FROM product_master
+                WHERE item_code IN ({placeholders})
+            """), params)
+            self.__store(result.mappings().all())
+        self.__version = version
+        logger.debug(f"ProductRackIndex refreshed {len(item_codes)} item codes (version {self.__version})")
+
+    def invalidate(self):
+        self.__racks = {}
+        self.__loaded = False
+
+    def get_rack_no(self, product_name, batch_number, expiry_date, mrp) -> str:
+        """Call ensure_loaded first."""
+        return self.__racks.get(self.make_key(product_name, batch_number, expiry_date, mrp), "0")
+
+
+product_rack_index = ProductRackIndex()
@@ -1,15 +1,118 @@
-from rapidfuzz import process
+from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
+from operator import itemgetter, or_, and_
+import numpy as np
 from src.logger.logger_setup import logger
 from fastapi import HTTPException
 from sqlalchemy import text
-import re
 from src.helpers.invoices import update_invoice_status_base_query, invoice_product_exist, invoice_product_list_insert_query, \
     epoch_to_str, invoices_metadata_field_map
 from datetime import datetime
 import uuid
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional, Tuple, List
-from src.helpers.invoices import FlowType
+from src.helpers.invoices import FlowType, existing_invoice_ids, normalize_batch_key, SCAN_BATCH_STRIP_PATTERN
+from src.core.config import settings
+from src.services.product_catalog import product_catalog, invoice_catalogs, scan_match_cache, PRODUCT_COLUMNS, \
+    BATCH_NGRAM_MIN_SCORE
+from src.services.invoices import IN_QUERY_CHUNK_SIZE, build_in_filter
+from src.services.scan_trace import ScanTrace, scan_stage_metrics
+
+
+class BatchScorer:
+    """
+    rapidfuzz WRatio scores of scanned batch numbers against candidate batch numbers. Pairs are scored
+    with process.cdist, many scanned batches against many candidates per call on PRODUCT_MATCH_FUZZY_WORKERS
+    threads, and kept, so a batch of scans sharing one scorer never scores the same pair twice.
+    """
+
+    def __init__(self):
+        self.__scores = {}
+
+    def score(self, batch_numbers, candidates):
+        """Scores every (batch number, candidate) pair not scored yet."""
+        queries = list(dict.fromkeys(batch_numbers))
+        choices = [candidate for candidate in dict.fromkeys(candidates)
+                   if any(candidate not in self.__scores.get(query, ()) for query in queries)]
+        if not queries or not choices:
+            return
+        matrix = process.cdist(queries, choices, scorer=fuzz.WRatio, processor=default_process,
+                               score_cutoff=settings.PRODUCT_MATCH_FUZZY_SCORE_CUTOFF,
+                               workers=settings.PRODUCT_MATCH_FUZZY_WORKERS)
+        for query, row in zip(queries, matrix.tolist()):
+            self.__scores.setdefault(query, {}).update(zip(choices, row))
+
+    def matches(self, batch_number, candidates) -> list:
+        """Every distinct candidate longer than 3 characters scoring at least the cutoff, best first."""
+        self.score([batch_number], candidates)
+        scores = self.__scores.get(batch_number, {})
+        found = [candidate for candidate in dict.fromkeys(candidates)
+                 if scores[candidate] >= settings.PRODUCT_MATCH_FUZZY_SCORE_CUTOFF and len(candidate) > 3]
+        return sorted(found, key=scores.get, reverse=True)
+
+
+# Below this many candidates plain list comprehensions beat building numpy columns
+CANDIDATE_SET_COLUMNAR_MIN = 200
+
+
+class CandidateSet:
+    """
+    Boolean masks over the products a Finder search filters, in their original order.
+    From CANDIDATE_SET_COLUMNAR_MIN products on, MRPs are a float array and other columns object arrays,
+    each built once on first use, so every filter is one vectorised comparison; smaller sets, the
+    usual batch or barcode hit, use lists of bools and skip the array construction.
+    """
+
+    def __init__(self, products: list):
+        self.products = products
+        self.columnar = len(products) >= CANDIDATE_SET_COLUMNAR_MIN
+        self.__columns = {}
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    @property
+    def mrps(self):
+        if "mrp" not in self.__columns:
+            self.__columns["mrp"] = np.fromiter(map(itemgetter("mrp"), self.products), float, len(self.products))
+        return self.__columns["mrp"]
+
+    def column(self, name):
+        if name not in self.__columns:
+            values = np.empty(len(self.products), dtype=object)
+            values[:] = list(map(itemgetter(name), self.products))
+            self.__columns[name] = values
+        return self.__columns[name]
+
+    def mask(self, value: bool):
+        if self.columnar:
+            return np.full(len(self.products), value, dtype=bool)
+        return [value] * len(self.products)
+
+    def mrp_within(self, mrp: float, tolerance: float):
+        if self.columnar:
+            return np.abs(self.mrps - mrp) <= tolerance
+        return [abs(float(product["mrp"]) - mrp) <= tolerance for product in self.products]
+
+    def equals(self, name, value):
+        if self.columnar:
+            return self.column(name) == value
+        return [product[name] == value for product in self.products]
+
+    def count(self, mask) -> int:
+        return int(np.count_nonzero(mask)) if self.columnar else sum(mask)
+
+    def either(self, mask, other):
+        return mask | other if self.columnar else list(map(or_, mask, other))
+
+    def both(self, mask, other):
+        return mask & other if self.columnar else list(map(and_, mask, other))
+
+    def take(self, mask) -> list:
+        if self.columnar:
+            return list(map(self.products.__getitem__, np.flatnonzero(mask).tolist()))
+        return [product for product, keep in zip(self.products, mask) if keep]
+
 
 class Finder:
     """
@@ -17,7 +120,8 @@ class Finder:
     search strategies (batch, expiry, MFG, MRP, fuzzy) purely via DB queries.
     """
 
-    def __init__(self, db_session, batch_number, expiry_date,mrp, mfg_date=None, barcode1=None, barcode2=None, rack_id=None):
+    def __init__(self, db_session, batch_number, expiry_date,mrp, mfg_date=None, barcode1=None, barcode2=None, rack_id=None,
+                 batch_scorer=None, trace=None, window_fallback=True):
         self.__db = db_session      # <-- store the session
         self.__batch_number = batch_number or ""
         self.__expiry_date = expiry_date or ""
@@ -26,90 +130,155 @@ class Finder:
         self.__barcode1 = barcode1 or ""
         self.__barcode2 = barcode2 or ""
         self.__rack_id = rack_id
+        self.__batch_scorer = batch_scorer or BatchScorer()
+        self.__trace = trace or ScanTrace()
+        # Without it the fuzzy step only returns products whose batch reaches the fuzzy cutoff,
+        # never the whole expiry / mfg / MRP window
+        self.__window_fallback = window_fallback
         self.__products = []
-        
 
-    async def find_products_by_batch(self):
-        """Directly find products by batch number."""
-        if not self.__batch_number:
-            logger.debug("No batch number provided.")
-            return []
+    # Data access used by the search steps below; CatalogFinder answers the same calls from memory.
+
+    async def fetch_products_by_batch(self, batch_number) -> list:
         query = """
             SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
             barcode1,barcode2,optional1,optional2 FROM product_master
             WHERE batch_number = :batch
         """
+        result = await self.__db.execute(text(query), {"batch": batch_number})
+        rows = result.mappings().all()  # returns list[dict]
+        return [dict(row) for row in rows]
+
+    async def fetch_products_by_batch_key(self, batch_key) -> list:
+        query = """
+            SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
+            barcode1,barcode2,optional1,optional2 FROM product_master
+            WHERE batch_key = :batch_key
+        """
+        result = await self.__db.execute(text(query), {"batch_key": batch_key})
+        return [dict(row) for row in result.mappings().all()]
+
+    async def fetch_products_by_barcode(self, barcode) -> list:
+        query = """
+            SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
+            barcode1,barcode2,optional1,optional2
+            FROM product_master
+            WHERE barcode1 = :barcode OR barcode2 = :barcode
+        """
+        result = await self.__db.execute(text(query), {"barcode": barcode})
+        return result.mappings().all()
+
+    async def fetch_products_by_dates_mrp(self, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None,
+                                          batch_numbers=None) -> list:
+        """Products matching every given condition: expiry date, mfg date, MRP range and batch numbers."""
+        params = {}
+        conditions = []
+        base_query = """
+            SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
+            barcode1,barcode2,optional1,optional2
+            FROM product_master WHERE
+        """
+
+        if expiry_date is not None:
+            conditions.append("expiry_date = :expiry_date")
+            params["expiry_date"] = expiry_date
+
+        if mfg_date is not None:
+            conditions.append("mfg_date = :mfg_date")
+            params["mfg_date"] = mfg_date
+
+        if min_mrp is not None:
+            conditions.append("(mrp >= :min_mrp AND mrp <= :max_mrp)")
+            params["min_mrp"] = min_mrp
+            params["max_mrp"] = max_mrp
+
+        query = base_query + " AND ".join(conditions)
+        if batch_numbers:
+            placeholders = ", ".join([f":b{i}" for i in range(len(batch_numbers))])
+            query += f" AND batch_number IN ({placeholders})"
+            params.update({f"b{i}": b for i, b in enumerate(batch_numbers)})
+
+        result = await self.__db.execute(text(query), params)
+        rows = result.mappings().all()
+        return [dict(row) for row in rows]
+
+    def narrow_batch_candidates(self, batch_number, batches: list) -> list:
+        """Batches worth scoring against batch_number with rapidfuzz; Finder scores all of them."""
+        return batches
+        
+
+    async def find_products_by_batch(self):
+        """Directly find products by batch number, then by normalised batch key (dashes, spaces, O/0, I/1)."""
+        if not self.__batch_number:
+            logger.debug("No batch number provided.")
+            return []
         # self.__products = self.__db.exec_query(query, [self.__batch_number])
         # logger.debug(f"Found {len(self.__products)} products by batch.")
         # return self.__products
         try:
-            result = await self.__db.execute(text(query), {"batch": self.__batch_number})
-            rows = result.mappings().all()  # returns list[dict]
-            self.__products = [dict(row) for row in rows]
+            self.__products = await self.fetch_products_by_batch(self.__batch_number)
             logger.debug(f"Found {len(self.__products)} products by batch: {self.__batch_number}")
+            if not self.__products:
+                batch_key = normalize_batch_key(self.__batch_number)
+                if batch_key:
+                    self.__products = await self.fetch_products_by_batch_key(batch_key)
+                    logger.debug(f"Found {len(self.__products)} products by batch key: {batch_key}")
             return self.__products
 
         except Exception as e:
             logger.exception(f"Error finding products by batch: {e}")
             return []
 
-    async def find_products_by_fuzzy_logic(self, skip_mfg=False):
-        """Find similar batches using expiry, mfg, and MRP."""
-        logger.debug("Inside find_products_by_fuzzy_logic")
-
+    def fuzzy_search_params(self, skip_mfg=False) -> dict | None:
+        """Expiry, mfg and MRP range conditions of the fuzzy search; None with less than 2 of them."""
         params = {}
-        conditions = []
-        base_query = """
-            SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
-            barcode1,barcode2,optional1,optional2
-            FROM product_master WHERE
-        """
 
         if self.__expiry_date:
-            conditions.append("expiry_date = :expiry_date")
             params["expiry_date"] = self.__expiry_date
 
         if not skip_mfg and self.__mfg_date:
-            conditions.append("mfg_date = :mfg_date")
             params["mfg_date"] = self.__mfg_date
 
         if self.__mrp:
             try:
                 mrp = float(self.__mrp)
-                conditions.append("(mrp >= :min_mrp AND mrp <= :max_mrp)")
                 params["min_mrp"] = mrp - 1
                 params["max_mrp"] = mrp + 1
             except ValueError:
                 logger.debug("Invalid MRP value for fuzzy search")
 
-        if len(conditions) < 2:
+        # expiry, mfg and the MRP range each count as one parameter
+        if len(params) - ("max_mrp" in params) < 2:
             logger.debug("Cannot perform fuzzy search with less than 2 parameters")
+            return None
+        return params
+
+    def fuzzy_window_params(self) -> dict | None:
+        """Conditions of a superset of the rows both fuzzy passes read: without mfg unless that pass is invalid."""
+        return self.fuzzy_search_params(skip_mfg=True) or self.fuzzy_search_params()
+
+    async def find_products_by_fuzzy_logic(self, skip_mfg=False):
+        """Find similar batches using expiry, mfg, and MRP."""
+        logger.debug("Inside find_products_by_fuzzy_logic")
+
+        params = self.fuzzy_search_params(skip_mfg)
+        if params is None:
             return []
 
-        query = base_query + " AND ".join(conditions)
         try:
             # ---  Execute query
-            result = await self.__db.execute(text(query), params)
-            rows = result.mappings().all()
-            self.__products = [dict(row) for row in rows]
+            self.__products = await self.fetch_products_by_dates_mrp(**params)
             logger.debug(f"Found {len(self.__products)} products in fuzzy search")
 
             # ---  Fuzzy batch name match
-            batches = [p["batch_number"] for p in self.__products if p.get("batch_number")]
-            if not batches:
-                return self.__products
-            scores = process.extract(self.__batch_number, batches)
-            found_batches = [batch for (batch, score, _) in scores if score >= 80 and len(batch) > 3]
+            batches = self.narrow_batch_candidates(
+                self.__batch_number, [p["batch_number"] for p in self.__products if p.get("batch_number")]
+            )
+            found_batches = self.__batch_scorer.matches(self.__batch_number, batches) if batches else []
             if found_batches:
-                placeholders = ", ".join([f":b{i}" for i in range(len(found_batches))])
-                batch_params = {f"b{i}": b for i, b in enumerate(found_batches)}
-
-                fuzzy_query = query + f" AND batch_number IN ({placeholders})"
-                params.update(batch_params)
-
-                result = await self.__db.execute(text(fuzzy_query), params)
-                rows = result.mappings().all()
-                self.__products = [dict(row) for row in rows]
+                self.__products = await self.fetch_products_by_dates_mrp(**params, batch_numbers=found_batches)
+            elif not self.__window_fallback:
+                self.__products = []
        
             return self.__products
 
@@ -117,36 +286,31 @@ class Finder:
             logger.exception(f"Error in find_products_by_fuzzy_logic: {e}")
             return []
 
-    def filter_by_mrp(self):
-        """Filter by MRP tolerance ±1."""
+    def filter_by_mrp(self, candidates: "CandidateSet"):
+        """Mask of the candidates within MRP tolerance ±1."""
         logger.debug(f"Filtering by MRP: {self.__mrp}")
         if not self.__mrp:
-            return self.__products
+            return candidates.mask(True)
         try:
             mrp = float(self.__mrp)
         except ValueError:
             logger.debug("Invalid MRP value for filter_by_mrp")
-            return []
-        return [
-            p for p in self.__products
-            if abs(float(p.get("mrp", 0)) - mrp) <= 1
-        ]
+            return candidates.mask(False)
+        return candidates.mrp_within(mrp, 1)
 
-    def filter_by_expiry(self):
-        """Filter by expiry date."""
+    def filter_by_expiry(self, candidates: "CandidateSet"):
+        """Mask of the candidates with the expiry date."""
         logger.debug(f"Filtering by expiry date: {self.__expiry_date}")
         if not self.__expiry_date:
-            return self.__products
-        # for p in self.__products:
-        #     print("product expiry_date",p.get("expiry_date"),p.get("id"))
-        return [p for p in self.__products if p.get("expiry_date") == self.__expiry_date]
+            return candidates.mask(True)
+        return candidates.equals("expiry_date", self.__expiry_date)
 
-    def filter_by_mfg(self):
-        """Filter by manufacturing date."""
+    def filter_by_mfg(self, candidates: "CandidateSet"):
+        """Mask of the candidates with the manufacturing date."""
         logger.debug(f"Filtering by MFG date: {self.__mfg_date}")
         if not self.__mfg_date:
-            return self.__products
-        return [p for p in self.__products if p.get("mfg_date") == self.__mfg_date]
+            return candidates.mask(True)
+        return candidates.equals("mfg_date", self.__mfg_date)
     
     # def filter_by_barcode(self):
     #     """Filter by barcode1 or barcode2 match."""
@@ -171,14 +335,7 @@ class Finder:
         if self.__products is None:
             self.__products = []
 
-        query = """
-            SELECT id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
-            barcode1,barcode2,optional1,optional2
-            FROM product_master
-            WHERE barcode1 = :barcode OR barcode2 = :barcode
-        """
-        result = await self.__db.execute(text(query), {"barcode": barcode})
-        self.__products = result.mappings().all()
+        self.__products = await self.fetch_products_by_barcode(barcode)
         
         logger.debug(f"Found {len(self.__products)} products by barcode")
         return self.__products
@@ -208,26 +365,44 @@ class Finder:
         1. Batch → Direct match
         2. Fuzzy → Similar match
         3. Filter → MRP, Expiry, MFG
+        Every step is timed as a stage of the ScanTrace, which also records the step that decided the result.
         """
         logger.debug("Starting search process")
 
         if self.__barcode1:
-            if await self.check_barcode(self.__barcode1):
+            with self.__trace.stage("barcode1") as stage:
+                found = await self.check_barcode(self.__barcode1)
+                stage["candidates"] = len(self.__products)
+            if found:
+                self.__trace.decide("barcode1")
                 return self.__products
             
         if self.__barcode2:
-            if await self.check_barcode(self.__barcode2):
+            with self.__trace.stage("barcode2") as stage:
+                found = await self.check_barcode(self.__barcode2)
+                stage["candidates"] = len(self.__products)
+            if found:
+                self.__trace.decide("barcode2")
                 return self.__products
         
         # 1 Try direct batch search
-        await self.find_products_by_batch()
+        with self.__trace.stage("batch") as stage:
+            await self.find_products_by_batch()
+            stage["candidates"] = len(self.__products)
+        step = "batch"
 
         # 2 If none found, try fuzzy search
         if not self.__products:
-            tmp_products = await self.find_products_by_fuzzy_logic()
+            with self.__trace.stage("fuzzy") as stage:
+                tmp_products = await self.find_products_by_fuzzy_logic()
+                stage["candidates"] = len(tmp_products)
+            step = "fuzzy"
             logger.info(f"products found using find_products_by_fuzzy_logic: {len(tmp_products)}")
             if not tmp_products:
-                tmp_products = await self.find_products_by_fuzzy_logic(skip_mfg=True)
+                with self.__trace.stage("fuzzy_skip_mfg") as stage:
+                    tmp_products = await self.find_products_by_fuzzy_logic(skip_mfg=True)
+                    stage["candidates"] = len(tmp_products)
+                step = "fuzzy_skip_mfg"
                 logger.info(f"products found without using mfg find_products_by_fuzzy_logic: {len(tmp_products)}")
             self.__products = tmp_products
 
@@ -235,85 +410,282 @@ class Finder:
             logger.debug("No products found even after fuzzy search")
             return []
 
-        # Apply hierarchical filtering
-        filtered = self.__products
-        
-        mrp_filtered = []
-        expiry_filtered = []
+        with self.__trace.stage("filter") as stage:
+            filtered = self.filter_products()
+            stage["candidates"] = len(filtered)
+        if filtered:
+            self.__trace.decide(step)
+        return filtered
+
+    def filter_products(self) -> list:
+        """
+        MRP / expiry union of the found products, then the MFG filter when more than 5 remain.
+        Each filter is one mask over a CandidateSet of the products.
+        """
+        candidates = CandidateSet(self.__products)
+        filtered = candidates.mask(False)
+        mrp_count = 0
 
         if self.__mrp:
-            mrp_filtered = self.filter_by_mrp()
-            logger.debug(f"After MRP filter: {len(mrp_filtered)} products")
+            filtered = self.filter_by_mrp(candidates)
+            mrp_count = candidates.count(filtered)
+            logger.debug(f"After MRP filter: {mrp_count} products")
                 
-        if (not mrp_filtered or len(mrp_filtered)>5) and self.__expiry_date:
+        if (not mrp_count or mrp_count>5) and self.__expiry_date:
             
-            expiry_filtered = self.filter_by_expiry()
-            logger.debug(f"After expiry filter: {len(expiry_filtered)} products")
+            expiry_filtered = self.filter_by_expiry(candidates)
+            logger.debug(f"After expiry filter: {candidates.count(expiry_filtered)} products")
+            filtered = candidates.either(filtered, expiry_filtered)
         
-        if mrp_filtered or expiry_filtered:
-            combined = mrp_filtered + expiry_filtered
-            combined_ids = {p.get("id") for p in combined if p.get("id")}
-            # Keep only matching ones from original products
-            filtered = [p for p in self.__products if p.get("id") in combined_ids]
-            logger.debug(f"Matched {len(filtered)} products after MRP/Expiry intersection filter")
-        else:
+        filtered_count = candidates.count(filtered)
+        if not filtered_count:
             # If no MRP or Expiry match — return empty
             logger.debug("No products matched either MRP or Expiry")
             return []
+        logger.debug(f"Matched {filtered_count} products after MRP/Expiry intersection filter")
         
         # Apply MFG filter only if date present and more than 5 products
-        if self.__mfg_date and len(filtered) > 5:
-            mfg_filtered = self.filter_by_mfg()
-            logger.debug(f"After MFG filter: {len(mfg_filtered)} products")
-
-            if not mfg_filtered:
-                # If no MFG matches, retain previous filtered
-                logger.debug("No products found by MFG — keeping previous filtered results")
+        if self.__mfg_date and filtered_count > 5:
+            # If no MFG matches or none of them is in filtered, the previous filtered results are kept
+            intersection = candidates.both(filtered, self.filter_by_mfg(candidates))
+            if candidates.count(intersection):
+                filtered = intersection
+                logger.debug(f"After MFG intersection: {candidates.count(filtered)} products retained")
             else:
-                # Compare with original filtered results (intersection)
-                mfg_ids = {p.get("id") for p in mfg_filtered if p.get("id")}
-                intersection = [p for p in filtered if p.get("id") in mfg_ids]
-
-                if intersection:
-                    filtered = intersection
-                    logger.debug(f"After MFG intersection: {len(filtered)} products retained")
-                else:
-                    # If intersection empty, retain previous filtered
-                    logger.debug("No intersection found — keeping previous filtered results")
-            
+                logger.debug("No intersection found — keeping previous filtered results")
 
+        filtered = candidates.take(filtered)
         logger.debug(f"Final matched {len(filtered)} products")
         return filtered
+
+
+class CatalogFinder(Finder):
+    """
+    Finder that runs the same search against an in-memory ProductCatalog instead of product_master:
+    the global product_catalog when PRODUCT_MATCH_IN_MEMORY is enabled (call ensure_loaded first),
+    or an invoice's catalog from invoice_catalogs for the invoice tier of match_scan.
+    """
+
+    def __init__(self, *args, catalog=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__catalog = catalog or product_catalog
+
+    async def fetch_products_by_batch(self, batch_number) -> list:
+        return self.__catalog.find_by_batch(batch_number)
+
+    async def fetch_products_by_batch_key(self, batch_key) -> list:
+        return self.__catalog.find_by_batch_key(batch_key)
+
+    async def fetch_products_by_barcode(self, barcode) -> list:
+        return self.__catalog.find_by_barcode(barcode)
+
+    async def fetch_products_by_dates_mrp(self, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None,
+                                          batch_numbers=None) -> list:
+        return self.__catalog.find_by_dates_mrp(expiry_date, mfg_date, min_mrp, max_mrp, batch_numbers)
+
+    def narrow_batch_candidates(self, batch_number, batches: list) -> list:
+        # The n-gram index only keeps every batch scoring BATCH_NGRAM_MIN_SCORE or more
+        if settings.PRODUCT_MATCH_FUZZY_SCORE_CUTOFF < BATCH_NGRAM_MIN_SCORE:
+            return batches
+        allowed = self.__catalog.batch_candidates(batch_number)
+        if allowed is None:
+            return batches
+        return [batch for batch in batches if batch in allowed]
+
+
+SCAN_CANDIDATE_SELECT = f"SELECT '{{source}}' AS source, rowid, {', '.join(PRODUCT_COLUMNS)} FROM product_master WHERE {{condition}}"
+
+
+def window_condition(window: dict, suffix="") -> Tuple[str, dict]:
+    """SQL condition and params of a fuzzy window from Finder.fuzzy_window_params."""
+    conditions = [f"{column} = :{column}{suffix}" for column in ("expiry_date", "mfg_date") if column in window]
+    if "min_mrp" in window:
+        conditions.append(f"(mrp >= :min_mrp{suffix} AND mrp <= :max_mrp{suffix})")
+    return " AND ".join(conditions), {f"{key}{suffix}": value for key, value in window.items()}
+
+
+def scan_window_key(window: dict) -> tuple:
+    return tuple(sorted(window.items()))
+
+
+def _mrp_order(mrp) -> float:
+    # NULL and text MRPs sort first, like in the product_master (date, mrp) indexes
+    return mrp if isinstance(mrp, (int, float)) else float("-inf")
+
+
+def window_products(rows: dict, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None, batch_numbers=None) -> list:
+    """
+    fetch_products_by_dates_mrp over prefetched {rowid: product} rows of a wider window,
+    in the (mrp, rowid) order the product_master (date, mrp) indexes return them.
+    """
+    products = []
+    for rowid in sorted(rows, key=lambda rowid: (_mrp_order(rows[rowid]["mrp"]), rowid)):
+        row = rows[rowid]
+        if expiry_date is not None and row["expiry_date"] != expiry_date:
+            continue
+        if mfg_date is not None and row["mfg_date"] != mfg_date:
+            continue
+        if min_mrp is not None and not min_mrp <= _mrp_order(row["mrp"]) <= max_mrp:
+            continue
+        if batch_numbers and row["batch_number"] not in batch_numbers:
+            continue
+        products.append(row)
+    return products
+
+
+class SingleQueryFinder(Finder):
+    """
+    Finder for PRODUCT_MATCH_SINGLE_QUERY=true: every row a search can need (barcode hits, exact batch and
+    batch key hits, the expiry + MRP window of the fuzzy search) is read in one UNION ALL query tagged by
+    source, and the fetch_* calls of the usual barcode → batch → fuzzy → filter search are answered from
+    those rows, in the order the single-step queries return them.
+    """
+
+    def __init__(self, db_session, batch_number, expiry_date, mrp, mfg_date=None, barcode1=None, barcode2=None, rack_id=None,
+                 batch_scorer=None, trace=None):
+        super().__init__(db_session, batch_number, expiry_date, mrp, mfg_date, barcode1, barcode2, rack_id, batch_scorer,
+                         trace)
+        self.__db = db_session
+        self.__batch_number = batch_number or ""
+        self.__barcodes = [barcode for barcode in dict.fromkeys((barcode1, barcode2)) if barcode]
+        self.__candidates = {}
+        self.__trace = trace or ScanTrace()
+
+    def candidate_query(self) -> Tuple[str, dict]:
+        selects, params = [], {}
+        for i, barcode in enumerate(self.__barcodes):
+            selects.append(SCAN_CANDIDATE_SELECT.format(
+                source="barcode", condition=f"barcode1 = :barcode{i} OR barcode2 = :barcode{i}"))
+            params[f"barcode{i}"] = barcode
+
+        if self.__batch_number:
+            selects.append(SCAN_CANDIDATE_SELECT.format(source="batch", condition="batch_number = :batch"))
+            params["batch"] = self.__batch_number
+            batch_key = normalize_batch_key(self.__batch_number)
+            if batch_key:
+                selects.append(SCAN_CANDIDATE_SELECT.format(source="batch_key", condition="batch_key = :batch_key"))
+                params["batch_key"] = batch_key
+
+        window = self.fuzzy_window_params()
+        if window:
+            condition, window_params = window_condition(window)
+            selects.append(SCAN_CANDIDATE_SELECT.format(source="window", condition=condition))
+            params.update(window_params)
+
+        return " UNION ALL ".join(selects), params
+
+    async def load_candidates(self):
+        """Runs the candidate query and keeps its rows per source as {rowid: product}."""
+        self.__candidates = {}
+        query, params = self.candidate_query()
+        if not query:
+            return
+        result = await self.__db.execute(text(query), params)
+        for source, rowid, *row in result.all():
+            self.__candidates.setdefault(source, {})[rowid] = dict(zip(PRODUCT_COLUMNS, row))
+        logger.debug(f"SingleQueryFinder candidates: { {source: len(rows) for source, rows in self.__candidates.items()} }")
+
+    def __rows(self, source) -> list:
+        rows = self.__candidates.get(source, {})
+        return [rows[rowid] for rowid in sorted(rows)]
+
+    async def fetch_products_by_batch(self, batch_number) -> list:
+        return self.__rows("batch")
+
+    async def fetch_products_by_batch_key(self, batch_key) -> list:
+        return self.__rows("batch_key")
+
+    async def fetch_products_by_barcode(self, barcode) -> list:
+        rows = self.__rows("barcode")
+        first = [row for row in rows if row["barcode1"] == barcode]
+        return first + [row for row in rows if row["barcode2"] == barcode and row["barcode1"] != barcode]
+
+    async def fetch_products_by_dates_mrp(self, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None,
+                                          batch_numbers=None) -> list:
+        return window_products(self.__candidates.get("window", {}), expiry_date, mfg_date, min_mrp, max_mrp,
+                               batch_numbers)
+
+    async def search(self):
+        with self.__trace.stage("candidates") as stage:
+            await self.load_candidates()
+            stage["candidates"] = sum(len(rows) for rows in self.__candidates.values())
+        return await super().search()
     
     
 
-async def match_scan(db,data):
-    try:
-        new_batch = re.sub('[ @#$%^&*()!?-]', "", str(data.batch_number))
+def clean_scan_batch_number(batch_number) -> str:
+    return SCAN_BATCH_STRIP_PATTERN.sub("", str(batch_number))
 
-        # validate license
-        finder = Finder(db,new_batch, data.expiry_date, data.mrp, data.mfg_date, data.barcode1, data.barcode2)
-        result = await finder.search()
-        if not result or len(result) == 0:
-            logger.info(f"No products found for batch: {new_batch}")
-            return {
-                "status":"error",
-                "message":"Product not found",
-                "data":[] 
-            }
-        logger.info(f"Found {len(result)} matching products")
-        
-        # if len(result) == 1:
-        #     product = result[0]
-        #     await scan_match_record_entries(db,data,product)
-            
-        logger.info(f"Found {len(result)} matching products")
+
+def match_scan_response(result, new_batch, match_tier=None) -> dict:
+    if not result or len(result) == 0:
+        logger.info(f"No products found for batch: {new_batch}")
         return {
-            "status":"success",
-            "count_of_products_found":len(result),
-            "message":f"Found {len(result)} matching products",
-            "data":result
+            "status":"error",
+            "message":"Product not found",
+            "match_tier":None,
+            "data":[] 
         }
+    logger.info(f"Found {len(result)} matching products in the {match_tier}")
+    return {
+        "status":"success",
+        "count_of_products_found":len(result),
+        "message":f"Found {len(result)} matching products",
+        "match_tier":match_tier,
+        "data":result
+    }
+
+
+async def search_invoice_tier(db, data, new_batch, trace=None) -> list:
+    """
+    Finder search over the product master rows of the invoice's own lines. Only a barcode, exact batch /
+    batch_key or fuzzy batch hit counts: the expiry / MRP window fallback would return another invoice
+    line for a product that is not on the invoice, so without a batch hit the catalogue tier decides.
+    """
+    if not settings.PRODUCT_MATCH_INVOICE_FIRST or not data.invoice_id:
+        return []
+    catalog = await invoice_catalogs.get(db, data.invoice_id)
+    if not len(catalog):
+        return []
+    finder = CatalogFinder(db,new_batch, data.expiry_date, data.mrp, data.mfg_date, data.barcode1, data.barcode2,
+                           catalog=catalog, trace=trace, window_fallback=False)
+    return await finder.search()
+
+
+def scan_cache_key(data, new_batch) -> tuple:
+    # The invoice only changes the answer when the invoice tier is searched
+    invoice_id = data.invoice_id if settings.PRODUCT_MATCH_INVOICE_FIRST else None
+    return scan_match_cache.make_key(invoice_id, new_batch, data.expiry_date, data.mrp, data.mfg_date,
+                                     data.barcode1, data.barcode2)
+
+
+async def match_scan(db,data,debug=False):
+    """
+    Searches the invoice's own lines first ("invoice" tier) and the whole product master only
+    when nothing there matches ("catalogue" tier); the response reports the tier in match_tier.
+    Responses are cached per cleaned scan tuple in scan_match_cache.
+    Every stage is timed in a ScanTrace: returned in "trace" with debug, and added to
+    scan_stage_metrics when MATCH_SCAN_TRACE is enabled.
+    """
+    try:
+        trace = ScanTrace()
+        new_batch = clean_scan_batch_number(data.batch_number)
+        cache_key = scan_cache_key(data, new_batch)
+        with trace.stage("cache"):
+            cached = scan_match_cache.get(cache_key)
+        if cached is not None:
+            trace.decide("cache")
+            response = cached
+        else:
+            generation = scan_match_cache.generation
+            response = await search_scan(db, data, new_batch, trace)
+            scan_match_cache.put(cache_key, response, generation)
+
+        if settings.MATCH_SCAN_TRACE:
+            scan_stage_metrics.observe(trace)
+        if debug:
+            return {**response, "trace": trace.as_dict()}
+        return response
     
     except HTTPException:
         raise
@@ -323,6 +695,241 @@ async def match_scan(db,data):
             status_code=400,
             detail={"status": "error", "message": str(e).split("\n")[0][:100]},
         )
+
+
+async def search_scan(db, data, new_batch, trace: ScanTrace) -> dict:
+    with trace.stage("invoice") as stage:
+        result = await search_invoice_tier(db, data, new_batch, trace)
+        stage["candidates"] = len(result)
+    if result:
+        return match_scan_response(result, new_batch, "invoice")
+
+    # validate license
+    with trace.stage("catalogue") as stage:
+        args = (db,new_batch, data.expiry_date, data.mrp, data.mfg_date, data.barcode1, data.barcode2)
+        if settings.PRODUCT_MATCH_IN_MEMORY:
+            await product_catalog.ensure_loaded(db)
+            finder = CatalogFinder(*args, trace=trace)
+        elif settings.PRODUCT_MATCH_SINGLE_QUERY:
+            finder = SingleQueryFinder(*args, trace=trace)
+        else:
+            finder = Finder(*args, trace=trace)
+        result = await finder.search()
+        stage["candidates"] = len(result)
+    
+    # if len(result) == 1:
+    #     product = result[0]
+    #     await scan_match_record_entries(db,data,product)
+        
+    return match_scan_response(result, new_batch, "catalogue")
+
+
+SCAN_PRODUCT_SELECT = """
+    SELECT rowid,batch_key,id,item_code,product_name,batch_number,expiry_date,mfg_date,mrp,division,obatch,
+    barcode1,barcode2,optional1,optional2 FROM product_master
+"""
+
+
+async def prefetch_scan_products(db, batch_numbers: set, barcodes: set) -> dict:
+    """
+    Product master rows for every batch number, batch key and barcode of a scan batch, in one IN query
+    per 500 values. Rows are grouped the way the single-value Finder queries return them: by rowid, and
+    for a barcode the barcode1 matches before the barcode2 matches.
+    """
+    by_batch, by_batch_key, by_barcode1, by_barcode2 = {}, {}, {}, {}
+    batch_numbers, barcodes = list(batch_numbers), list(barcodes)
+    batch_keys = list({normalize_batch_key(batch) for batch in batch_numbers} - {""})
+
+    for index in range(0, len(batch_numbers), IN_QUERY_CHUNK_SIZE):
+        params = {}
+        in_filter = build_in_filter("batch_number", batch_numbers[index:index + IN_QUERY_CHUNK_SIZE], "batch", params)
+        result = await db.execute(text(f"{SCAN_PRODUCT_SELECT} WHERE {in_filter}"), params)
+        for row in result.mappings().all():
+            by_batch.setdefault(row["batch_number"], []).append(dict(row))
+
+    for index in range(0, len(batch_keys), IN_QUERY_CHUNK_SIZE):
+        params = {}
+        in_filter = build_in_filter("batch_key", batch_keys[index:index + IN_QUERY_CHUNK_SIZE], "batch_key", params)
+        result = await db.execute(text(f"{SCAN_PRODUCT_SELECT} WHERE {in_filter}"), params)
+        for row in result.mappings().all():
+            by_batch_key.setdefault(row["batch_key"], []).append(dict(row))
+
+    for index in range(0, len(barcodes), IN_QUERY_CHUNK_SIZE):
+        params = {}
+        chunk = barcodes[index:index + IN_QUERY_CHUNK_SIZE]
+        barcode1_filter = build_in_filter("barcode1", chunk, "barcode", params)
+        barcode2_filter = build_in_filter("barcode2", chunk, "barcode", params)
+        result = await db.execute(text(f"{SCAN_PRODUCT_SELECT} WHERE {barcode1_filter} OR {barcode2_filter}"), params)
+        for row in result.mappings().all():
+            row = dict(row)
+            if row["barcode1"]:
+                by_barcode1.setdefault(row["barcode1"], []).append(row)
+            if row["barcode2"]:
+                by_barcode2.setdefault(row["barcode2"], []).append(row)
+
+    def without_rowid(rows):
+        return [{key: value for key, value in row.items() if key not in ("rowid", "batch_key")}
+                for row in sorted(rows, key=lambda row: row["rowid"])]
+
+    products_by_barcode = {}
+    for barcode in barcodes:
+        first = by_barcode1.get(barcode, [])
+        seen = {row["rowid"] for row in first}
+        products_by_barcode[barcode] = without_rowid(first) + without_rowid(
+            [row for row in by_barcode2.get(barcode, []) if row["rowid"] not in seen])
+
+    return {
+        "batch": {batch: without_rowid(rows) for batch, rows in by_batch.items()},
+        "batch_key": {batch_key: without_rowid(rows) for batch_key, rows in by_batch_key.items()},
+        "barcode": products_by_barcode,
+    }
+
+
+# Fuzzy windows read per UNION ALL query, well under SQLite's 500 compound SELECT terms
+WINDOW_QUERY_CHUNK_SIZE = 100
+
+
+async def prefetch_scan_windows(db, windows: list) -> dict:
+    """Product master rows of each fuzzy window as {rowid: product}, keyed by scan_window_key."""
+    rows = {scan_window_key(window): {} for window in windows}
+    keys = list(rows)
+    for index in range(0, len(keys), WINDOW_QUERY_CHUNK_SIZE):
+        selects, params = [], {}
+        for i in range(index, min(index + WINDOW_QUERY_CHUNK_SIZE, len(keys))):
+            condition, window_params = window_condition(dict(keys[i]), suffix=str(i))
+            selects.append(SCAN_CANDIDATE_SELECT.format(source=i, condition=condition))
+            params.update(window_params)
+        result = await db.execute(text(" UNION ALL ".join(selects)), params)
+        for source, rowid, *row in result.all():
+            rows[keys[int(source)]][rowid] = dict(zip(PRODUCT_COLUMNS, row))
+    return rows
+
+
+class PrefetchedFinder(Finder):
+    """
+    Finder for /match/scan/batch: batch and barcode lookups come from prefetch_scan_products, and
+    fuzzy lookups from prefetch_scan_windows when score_fuzzy_scans read the scan's window.
+    """
+
+    def __init__(self, prefetched: dict, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__prefetched = prefetched
+
+    async def fetch_products_by_batch(self, batch_number) -> list:
+        return list(self.__prefetched["batch"].get(batch_number, []))
+
+    async def fetch_products_by_batch_key(self, batch_key) -> list:
+        return list(self.__prefetched["batch_key"].get(batch_key, []))
+
+    async def fetch_products_by_barcode(self, barcode) -> list:
+        return list(self.__prefetched["barcode"].get(barcode, []))
+
+    async def fetch_products_by_dates_mrp(self, expiry_date=None, mfg_date=None, min_mrp=None, max_mrp=None,
+                                          batch_numbers=None) -> list:
+        window = self.fuzzy_window_params()
+        rows = self.__prefetched.get("window", {}).get(scan_window_key(window)) if window else None
+        if rows is None:
+            return await super().fetch_products_by_dates_mrp(expiry_date, mfg_date, min_mrp, max_mrp, batch_numbers)
+        return window_products(rows, expiry_date, mfg_date, min_mrp, max_mrp, batch_numbers)
+
+
+async def score_fuzzy_scans(db, finders: dict, batches: list, batch_scorer: BatchScorer, prefetched: dict | None):
+    """
+    Scores the scans of a batch that will reach the fuzzy step together: one cdist call per fuzzy
+    window, every scanned batch of the window against all of its candidate batches. For PrefetchedFinder
+    the windows are read with prefetch_scan_windows into prefetched["window"].
+    """
+    windows = {}
+    for position, finder in finders.items():
+        window, new_batch = finder.fuzzy_window_params(), batches[position]
+        if not window or not new_batch:
+            continue
+        if await finder.fetch_products_by_batch(new_batch):
+            continue
+        batch_key = normalize_batch_key(new_batch)
+        if batch_key and await finder.fetch_products_by_batch_key(batch_key):
+            continue
+        windows.setdefault(scan_window_key(window), (window, finder, []))[2].append(new_batch)
+
+    if prefetched is not None and windows:
+        prefetched["window"] = await prefetch_scan_windows(db, [window for window, _, _ in windows.values()])
+
+    for window, finder, batch_numbers in windows.values():
+        products = await finder.fetch_products_by_dates_mrp(**window)
+        batch_scorer.score(batch_numbers, [p["batch_number"] for p in products if p.get("batch_number")])
+
+
+async def match_scan_batch(db, items) -> list[dict]:
+    """
+    match_scan for several scans of the same scanner: invoices are checked in one query and all
+    batch numbers and barcodes are read with set-based queries before the per-item Finder cascade.
+    Scans already in scan_match_cache are answered from it.
+    Returns one match_scan style result per item, in request order.
+    """
+    try:
+        invoice_ids = await existing_invoice_ids(db, [item.invoice_id for item in items])
+        batches = [clean_scan_batch_number(item.batch_number) for item in items]
+
+        results = [None] * len(items)
+        pending, searched = [], []
+        generation = scan_match_cache.generation
+        for position, (item, new_batch) in enumerate(zip(items, batches)):
+            if item.invoice_id not in invoice_ids:
+                results[position] = {"status": "error", "message": "Invoice Not found", "data": []}
+                continue
+            if (not item.batch_number) or (not item.expiry_date) or (not item.mrp):
+                results[position] = {"status": "error", "message": "Not sufficient parameters to search products", "data": []}
+                continue
+            cached = scan_match_cache.get(scan_cache_key(item, new_batch))
+            if cached is not None:
+                results[position] = cached
+                continue
+            searched.append(position)
+            result = await search_invoice_tier(db, item, new_batch)
+            if result:
+                results[position] = match_scan_response(result, new_batch, "invoice")
+            else:
+                pending.append(position)
+
+        # Only the scans the invoice tier could not answer are looked up in the whole product master
+        prefetched = None
+        if pending and settings.PRODUCT_MATCH_IN_MEMORY:
+            await product_catalog.ensure_loaded(db)
+        elif pending:
+            barcodes = {barcode for position in pending
+                        for barcode in (items[position].barcode1, items[position].barcode2) if barcode}
+            prefetched = await prefetch_scan_products(
+                db, {batches[position] for position in pending if batches[position]}, barcodes)
+
+        batch_scorer = BatchScorer()
+        finders = {}
+        for position in pending:
+            item, new_batch = items[position], batches[position]
+            args = (db, new_batch, item.expiry_date, item.mrp, item.mfg_date, item.barcode1, item.barcode2)
+            if settings.PRODUCT_MATCH_IN_MEMORY:
+                finders[position] = CatalogFinder(*args, batch_scorer=batch_scorer)
+            else:
+                finders[position] = PrefetchedFinder(prefetched, *args, batch_scorer=batch_scorer)
+        await score_fuzzy_scans(db, finders, batches, batch_scorer, prefetched)
+
+        for position, finder in finders.items():
+            results[position] = match_scan_response(await finder.search(), batches[position], "catalogue")
+
+        for position in searched:
+            scan_match_cache.put(scan_cache_key(items[position], batches[position]), results[position], generation)
+
+        logger.info(f"match_scan_batch: {len(items)} scans, "
+                    f"{sum(result['status'] == 'success' for result in results)} matched")
+        return results
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"inside match_scan_batch {e}")
+        raise HTTPException(
+            status_code=400,
+            detail={"status": "error", "message": str(e).split("\n")[0][:100]},
+        )
         
 async def scan_match_record_entries(db,data,product):
     try:
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+from bisect import bisect_left
+import time
+
+# Upper bounds in ms of the per-stage latency histogram buckets; slower stages fall in "+Inf"
+SCAN_STAGE_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class ScanTrace:
+    """
+    Wall time and candidate count of every stage of one match_scan, in the order the stages started,
+    and the stage that produced the result. Stages nest: the "fuzzy" stage of the Finder run inside
+    the "catalogue" stage is recorded as "catalogue.fuzzy".
+    """
+
+    def __init__(self):
+        self.__started = time.perf_counter()
+        self.__path = []
+        self.stages = []
+        self.decision = None
+
+    @property
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.__started) * 1000, 3)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block; set "candidates" on the yielded entry to the number of products it left."""
+        self.__path.append(name)
+        entry = {"stage": ".".join(self.__path), "ms": 0.0, "candidates": None}
+        self.stages.append(entry)
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["ms"] = round((time.perf_counter() - start) * 1000, 3)
+            self.__path.pop()
+
+    def decide(self, step):
+        """Records step, under the stages currently running, as the one that produced the result."""
+        self.decision = ".".join(self.__path + [step])
+
+    def as_dict(self) -> dict:
+        return {"total_ms": self.total_ms, "decision": self.decision, "stages": self.stages}
+
+
+class ScanStageMetrics:
+    """
+    Latency histograms per match_scan stage (and "total") over SCAN_STAGE_BUCKETS_MS, with counts of the
+    deciding stages, for the scans traced while MATCH_SCAN_TRACE is enabled.
+    Lives in this worker process only.
+    """
+
+    def __init__(self):
+        self.__stages = {}
+        self.__decisions = {}
+        self.scans = 0
+
+    def observe(self, trace: ScanTrace):
+        self.scans += 1
+        decision = trace.decision or "not_found"
+        self.__decisions[decision] = self.__decisions.get(decision, 0) + 1
+        for name, ms in [(entry["stage"], entry["ms"]) for entry in trace.stages] + [("total", trace.total_ms)]:
+            stats = self.__stages.get(name)
+            if stats is None:
+                stats = self.__stages[name] = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0,
+                                               "buckets": [0] * (len(SCAN_STAGE_BUCKETS_MS) + 1)}
+            stats["count"] += 1
+            stats["sum_ms"] += ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            stats["buckets"][bisect_left(SCAN_STAGE_BUCKETS_MS, ms)] += 1
+
+    @staticmethod
+    def __quantile(stats: dict, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile; the max for the "+Inf" bucket."""
+        cumulative = 0
+        for bound, count in zip(SCAN_STAGE_BUCKETS_MS, stats["buckets"]):
+            cumulative += count
+            if cumulative >= q * stats["count"]:
+                return bound
+        return round(stats["max_ms"], 3)
+
+    def stats(self) -> dict:
+        stages = {}
+        for name, stats in sorted(self.__stages.items()):
+            cumulative, buckets = 0, {}
+            for bound, count in zip(SCAN_STAGE_BUCKETS_MS + ("+Inf",), stats["buckets"]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            stages[name] = {
+                "count": stats["count"],
+                "avg_ms": round(stats["sum_ms"] / stats["count"], 3),
+                "p50_ms": self.__quantile(stats, 0.5),
+                "p95_ms": self.__quantile(stats, 0.95),
+                "max_ms": round(stats["max_ms"], 3),
+                "buckets": buckets,
+            }
+        return {"scans": self.scans, "bucket_bounds_ms": list(SCAN_STAGE_BUCKETS_MS),
+                "decisions": dict(self.__decisions), "stages": stages}
+
+
+scan_stage_metrics = ScanStageMetrics()
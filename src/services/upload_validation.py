@@ -0,0 +1,140 @@
+from fastapi import HTTPException
+from src.core.config import settings
+from src.logger.logger_setup import logger
+from src.helpers.invoices import FileUploadType, parse_expiry_or_mfg_date
+from src.services.invoices import load_existing_invoices
+from src.services.uploads import stream_csv_rows
+import re
+
+# Columns every row must have a value for, per upload type
+REQUIRED_VALUES = {
+    FileUploadType.invoice: ("party_id", "invoice_no", "product_name"),
+    FileUploadType.party_master: ("party_code", "party_name"),
+    FileUploadType.product_master: ("item_code", "product_name"),
+    FileUploadType.rack_master: ("rack_no",),
+    FileUploadType.tray_master: ("tray_no",),
+}
+
+# Columns that must be in the header even when values may be blank
+REQUIRED_COLUMNS = {
+    FileUploadType.product_master: ("item_code", "product_name", "batch_number"),
+}
+
+NUMERIC_COLUMNS = {
+    FileUploadType.invoice: ("mrp", "qty"),
+    FileUploadType.product_master: ("mrp",),
+}
+
+MONTH_DATE_COLUMNS = {
+    FileUploadType.product_master: (("expiry_date", "expiry"), ("mfg_date", "mfg")),
+}
+
+NORMALIZED_DATE_PATTERN = re.compile(r"^\d{2}-\d{2}-\d{4}$")
+
+INVOICE_OVERRIDE_STATUSES = (None, "", "not_started")
+
+
+def new_validation_report(value: FileUploadType) -> dict:
+    return {
+        "file_type": value.value,
+        "dry_run": True,
+        "valid": True,
+        "rows_parsed": 0,
+        "error_count": 0,
+        "warning_count": 0,
+        "errors": [],
+        "warnings": [],
+    }
+
+
+def add_issue(report: dict, kind: str, row: int | None, column: str | None, message: str):
+    """Counts every issue but keeps at most UPLOAD_DRY_RUN_MAX_ERRORS of each kind in the report."""
+    report[f"{kind[:-1]}_count"] += 1
+    if len(report[kind]) < settings.UPLOAD_DRY_RUN_MAX_ERRORS:
+        report[kind].append({"row": row, "column": column, "message": message})
+
+
+def check_header(report: dict, value: FileUploadType, fieldnames):
+    columns = REQUIRED_COLUMNS.get(value, ()) + REQUIRED_VALUES.get(value, ())
+    for column in dict.fromkeys(columns):
+        if column not in fieldnames:
+            add_issue(report, "errors", None, column, f"Column '{column}' is missing from the CSV header")
+
+
+def check_batch_columns(report: dict, value: FileUploadType, rows: list[dict], start: int, fieldnames):
+    """Column-wise checks on one batch; rows are numbered from start like the upload error messages."""
+    for column in REQUIRED_VALUES.get(value, ()):
+        if column not in fieldnames:
+            continue
+        values = [row.get(column) for row in rows]
+        for offset in [i for i, cell in enumerate(values) if not cell or not cell.strip()]:
+            add_issue(report, "errors", start + offset, column,
+                      f"Missing '{column}' in row {start + offset}. It must be present for all entries.")
+
+    for column in NUMERIC_COLUMNS.get(value, ()):
+        if column not in fieldnames:
+            continue
+        for offset, cell in enumerate(row.get(column) for row in rows):
+            try:
+                float(cell or 0)
+            except (TypeError, ValueError):
+                add_issue(report, "errors", start + offset, column,
+                          f"Row {start + offset}: '{column}' value '{cell}' is not a number")
+
+    for column, date_type in MONTH_DATE_COLUMNS.get(value, ()):
+        if column not in fieldnames:
+            continue
+        for offset, cell in enumerate(row.get(column) for row in rows):
+            if not NORMALIZED_DATE_PATTERN.match(parse_expiry_or_mfg_date(cell or "", date_type) or ""):
+                add_issue(report, "warnings", start + offset, column,
+                          f"Row {start + offset}: '{column}' value '{cell}' could not be parsed and is stored as is")
+
+
+async def check_invoice_overrides(db, report: dict, rows: list[dict], start: int, upload_state: dict):
+    """Reports every existing invoice in the batch that is already in progress or completed, once per invoice."""
+    reported = upload_state.setdefault("reported_invoice_nos", set())
+    existing_invoices = await load_existing_invoices(db, {row.get("invoice_no") for row in rows}, upload_state)
+    for offset, row in enumerate(rows):
+        invoice_no = row.get("invoice_no")
+        invoice_info = existing_invoices.get(invoice_no)
+        if not invoice_info or invoice_no in reported:
+            continue
+        if invoice_info["status"] not in INVOICE_OVERRIDE_STATUSES or invoice_info["is_completed"] == True:
+            reported.add(invoice_no)
+            add_issue(report, "errors", start + offset, "invoice_no",
+                      f"Invoice {invoice_no} already {invoice_info['status']} is_completed:{invoice_info['is_completed']} — cannot override.")
+
+
+async def validate_upload_stream(db, file, value: FileUploadType) -> dict:
+    """
+    Dry run of /invoices/file_upload: streams the whole file through the upload checks and
+    returns every error and warning with its row number. Only reads from the DB.
+    """
+    try:
+        report = new_validation_report(value)
+        upload_state = {}
+        fieldnames = None
+
+        async for rows in stream_csv_rows(file):
+            start = report["rows_parsed"] + 1
+            report["rows_parsed"] += len(rows)
+            if fieldnames is None:
+                fieldnames = [name for name in rows[0].keys() if name is not None]
+                check_header(report, value, fieldnames)
+
+            check_batch_columns(report, value, rows, start, fieldnames)
+            if value == FileUploadType.invoice:
+                await check_invoice_overrides(db, report, rows, start, upload_state)
+
+        for kind in ("errors", "warnings"):
+            report[kind].sort(key=lambda issue: issue["row"] or 0)
+        report["valid"] = report["error_count"] == 0
+        logger.info(f"validate_upload_stream: {value.value} {report['rows_parsed']} rows, "
+                    f"{report['error_count']} errors, {report['warning_count']} warnings")
+        return report
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"validate_upload_stream: {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
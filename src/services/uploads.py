@@ -0,0 +1,746 @@
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import codecs
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from src.core.config import settings
+from src.db.database import async_session
+from src.logger.logger_setup import logger
+from src.helpers.invoices import FileUploadType
+from src.services.invoices import prepare_invoice_upload_data, save_invoice_upload_data, prepare_party_master_data, \
+    save_party_master_data, prepare_product_master_data, save_product_master_data, check_rack_no_rack_master, \
+    prepare_rack_master_data, save_rack_master_data, check_tray_no_tray_master, prepare_tray_master_data, \
+    save_tray_master_data
+from src.services.product_index import product_rack_index
+from src.services.product_catalog import product_catalog, invalidate_invoice_matches
+
+CSV_ENCODINGS = ("utf-8", "windows-1252", "iso-8859-1")
+
+COMPRESSED_UPLOAD_EXTENSIONS = (".csv.gz", ".zip")
+UPLOAD_FILE_EXTENSIONS = (".csv",) + COMPRESSED_UPLOAD_EXTENSIONS
+
+UPLOAD_SUCCESS_MESSAGES = {
+    FileUploadType.invoice: "Invoices data added successfully",
+    FileUploadType.party_master: "Party Master data added successfully",
+    FileUploadType.product_master: "Product Master data added successfully",
+    FileUploadType.rack_master: "Rack master data inserted/updated successfully.",
+    FileUploadType.tray_master: "Tray master data inserted/updated successfully.",
+}
+
+
+def check_upload_filename(filename: str):
+    if not (filename or "").lower().endswith(UPLOAD_FILE_EXTENSIONS):
+        logger.error("Only CSV files are allowed (.csv, .csv.gz or .zip)")
+        raise HTTPException(status_code=400, detail={"status":"error","message":"Only CSV files are allowed (.csv, .csv.gz or .zip)"})
+
+
+def is_compressed_upload(filename: str) -> bool:
+    return (filename or "").lower().endswith(COMPRESSED_UPLOAD_EXTENSIONS)
+
+
+async def gzip_upload_chunks(file, chunk_size: int):
+    """Decompresses a (possibly multi-member) gzip upload, yielding at most chunk_size bytes at a time."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_started = False
+    try:
+        while data := await file.read(chunk_size):
+            while data:
+                member_started = True
+                chunk = decompressor.decompress(data, chunk_size)
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    # Concatenated gzip members are read one after the other
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_started = False
+                else:
+                    data = decompressor.unconsumed_tail
+        if member_started:
+            # Input ended in the middle of a member; flush what is left and report the truncation
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+            raise zlib.error("unexpected end of gzip data")
+    except zlib.error as e:
+        logger.error(f"Invalid gzip upload: {e}")
+        raise HTTPException(status_code=400, detail={"status": "error", "message": f"Invalid gzip file: {e}"})
+
+
+def open_zip_csv_member(fileobj):
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as e:
+        logger.error(f"Invalid zip upload: {e}")
+        raise HTTPException(status_code=400, detail={"status": "error", "message": f"Invalid zip file: {e}"})
+
+    members = [
+        member for member in archive.infolist()
+        if not member.is_dir() and member.filename.lower().endswith(".csv")
+        and not member.filename.startswith("__MACOSX/")
+    ]
+    if len(members) != 1:
+        archive.close()
+        logger.error(f"Zip upload contains {len(members)} CSV files")
+        raise HTTPException(status_code=400, detail={"status": "error",
+                "message": f"Zip file must contain exactly one CSV file, found {len(members)}"})
+    return archive, archive.open(members[0])
+
+
+async def zip_upload_chunks(file, chunk_size: int):
+    """Streams the single CSV member of a zip upload; zipfile needs the seekable spooled file behind the upload."""
+    archive, member = await run_in_threadpool(open_zip_csv_member, file.file)
+    try:
+        while chunk := await run_in_threadpool(member.read, chunk_size):
+            yield chunk
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        logger.error(f"Invalid zip upload: {e}")
+        raise HTTPException(status_code=400, detail={"status": "error", "message": f"Invalid zip file: {e}"})
+    finally:
+        member.close()
+        archive.close()
+
+
+async def upload_chunks(file, chunk_size: int):
+    """Raw CSV bytes of the upload, decompressed on the fly for .csv.gz and .zip files."""
+    filename = (file.filename or "").lower()
+    if filename.endswith(".zip"):
+        async for chunk in zip_upload_chunks(file, chunk_size):
+            yield chunk
+    elif filename.endswith(".gz"):
+        async for chunk in gzip_upload_chunks(file, chunk_size):
+            yield chunk
+    else:
+        while chunk := await file.read(chunk_size):
+            yield chunk
+
+
+class CsvChunkDecoder:
+    """
+    Incrementally decodes upload chunks. Starts with utf-8 and falls back to
+    windows-1252 / iso-8859-1 from the first chunk the current encoding cannot decode.
+    """
+
+    def __init__(self):
+        self.__encoding_index = 0
+        self.__decoder = codecs.getincrementaldecoder(CSV_ENCODINGS[0])()
+
+    @property
+    def encoding(self):
+        return CSV_ENCODINGS[self.__encoding_index]
+
+    def decode(self, chunk: bytes, final: bool = False) -> str:
+        while True:
+            try:
+                return self.__decoder.decode(chunk, final)
+            except UnicodeDecodeError:
+                if self.__encoding_index == len(CSV_ENCODINGS) - 1:
+                    logger.error("CSV file encoding is not supported (utf-8 / windows-1252 / iso-8859-1)")
+                    raise HTTPException(
+                        status_code=400,
+                        detail={"status": "error",
+                                "message": "CSV file encoding is not supported (utf-8 / windows-1252 / iso-8859-1)"}
+                    )
+                # bytes held back for an incomplete sequence belong to this chunk as well
+                pending, _ = self.__decoder.getstate()
+                chunk = pending + chunk
+                self.__encoding_index += 1
+                self.__decoder = codecs.getincrementaldecoder(self.encoding)()
+                logger.info(f"CSV upload decoding switched to {self.encoding}")
+
+
+class CsvRecordSplitter:
+    """
+    Splits decoded text into lines and only releases lines that end on a CSV record
+    boundary, so quoted values containing newlines are never cut between batches.
+    """
+
+    def __init__(self):
+        self.__tail = ""
+        self.__pending = []
+        self.__pending_quotes = 0
+
+    @property
+    def buffered_chars(self) -> int:
+        return len(self.__tail) + sum(len(line) for line in self.__pending)
+
+    def feed(self, text: str) -> list[str]:
+        text = self.__tail + text
+        cut = text.rfind("\n")
+        if cut == -1:
+            self.__tail = text
+            return []
+        self.__tail = text[cut + 1:]
+
+        complete = []
+        for line in text[:cut].split("\n"):
+            line += "\n"
+            self.__pending.append(line)
+            self.__pending_quotes += line.count('"')
+            # An even number of quotes means every quoted value has been closed
+            if self.__pending_quotes % 2 == 0:
+                complete.extend(self.__pending)
+                self.__pending = []
+                self.__pending_quotes = 0
+        return complete
+
+    def flush(self) -> list[str]:
+        lines = self.__pending + ([self.__tail] if self.__tail else [])
+        self.__tail = ""
+        self.__pending = []
+        self.__pending_quotes = 0
+        return lines
+
+
+def csv_records(lines: list[str]):
+    """Yields (values, chars) for every record in lines, chars being the raw text size of the record."""
+    line_ends = []
+    total = 0
+    for line in lines:
+        total += len(line)
+        line_ends.append(total)
+
+    reader = csv.reader(lines)
+    consumed = 0
+    for values in reader:
+        end = line_ends[reader.line_num - 1]
+        yield values, end - consumed
+        consumed = end
+
+
+def csv_row_dict(fieldnames: list[str], values: list[str]) -> dict:
+    """Same row shape as csv.DictReader."""
+    row = dict(zip(fieldnames, values))
+    if len(fieldnames) < len(values):
+        row[None] = values[len(fieldnames):]
+    elif len(fieldnames) > len(values):
+        for key in fieldnames[len(values):]:
+            row[key] = None
+    return row
+
+
+async def stream_csv_rows(file, batch_size: int | None = None, memory_limit_mb: int | None = None):
+    """
+    Reads the UploadFile chunk by chunk (decompressing .csv.gz / .zip uploads) and yields lists
+    of non-empty row dicts. A batch is released when it holds batch_size rows or its raw text
+    reaches the memory limit.
+    """
+    check_upload_filename(file.filename)
+
+    chunk_size = settings.UPLOAD_CHUNK_SIZE_KB * 1024
+    batch_size = batch_size or settings.UPLOAD_BATCH_SIZE
+    memory_limit = (memory_limit_mb or settings.UPLOAD_MEMORY_LIMIT_MB) * 1024 * 1024
+
+    decoder = CsvChunkDecoder()
+    splitter = CsvRecordSplitter()
+    fieldnames = None
+    batch = []
+    batch_chars = 0
+    total_rows = 0
+
+    chunks = upload_chunks(file, chunk_size)
+    while True:
+        chunk = await anext(chunks, b"")
+        final = not chunk
+        lines = splitter.feed(decoder.decode(chunk, final))
+        if final:
+            lines += splitter.flush()
+
+        if splitter.buffered_chars > memory_limit:
+            logger.error("CSV record exceeds the upload memory limit")
+            raise HTTPException(status_code=400, detail={"status": "error",
+                    "message": f"CSV record exceeds the upload memory limit of {memory_limit // (1024 * 1024)} MB"})
+
+        for values, chars in csv_records(lines):
+            if fieldnames is None:
+                fieldnames = values
+                continue
+            if not values:
+                continue
+            row = csv_row_dict(fieldnames, values)
+            if not any(value and str(value).strip() for value in row.values()):
+                continue
+
+            batch.append(row)
+            batch_chars += chars
+            if len(batch) >= batch_size or batch_chars >= memory_limit:
+                total_rows += len(batch)
+                yield batch
+                batch = []
+                batch_chars = 0
+
+        if final:
+            break
+
+    if batch:
+        total_rows += len(batch)
+        yield batch
+
+    if not total_rows:
+        logger.error("CSV file is empty")
+        raise HTTPException(status_code=400, detail={"status":"error","message":"CSV file is empty"})
+    logger.info(f"stream_csv_rows: {total_rows} rows read, encoding {decoder.encoding}")
+
+
+def new_upload_stats(value: FileUploadType) -> dict:
+    return {
+        "file_type": value.value,
+        "rows_parsed": 0,
+        "rows_written": 0,
+        "batches": 0,
+        "elapsed_seconds": 0.0,
+        "rows_per_second": 0.0,
+    }
+
+
+def update_upload_throughput(stats: dict, started: float):
+    elapsed = time.perf_counter() - started
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["rows_per_second"] = round(stats["rows_parsed"] / elapsed, 2) if elapsed > 0 else 0.0
+
+
+async def process_upload_stream(db, file, value: FileUploadType, current_user, stats: dict | None = None,
+                                batch_pause: float = 0, delta: bool = False, batch_size: int | None = None,
+                                offload: bool = False):
+    """
+    Streams the uploaded CSV through the prepare_* / save_* stages batch by batch.
+    Master files are saved and committed per batch, so a write lock is never held for the whole file:
+    an error in a later batch leaves the earlier batches stored, and the error detail reports them
+    as rows_committed (re-uploading the corrected file upserts the rest). Invoice files are prepared
+    per batch and saved in one transaction at the end, because qty merging and invoice overrides span
+    the whole file; their prepared rows are kept in memory until then, so only the raw text is bounded.
+    stats is updated in place so callers can follow progress, and batch_pause (seconds)
+    is slept after every batch to leave room for other requests.
+    delta=True writes only new or changed product master rows and counts them in stats.
+    batch_size overrides UPLOAD_BATCH_SIZE, and offload=True normalises product master rows
+    off the event loop (see prepare_product_master_data).
+    """
+    if stats is None:
+        stats = new_upload_stats(value)
+    try:
+        started = time.perf_counter()
+
+        invoice_state = {}
+        party_rows, invoice_rows, product_rows = [], [], []
+        overridden_invoice_ids = set()
+
+        async for rows in stream_csv_rows(file, batch_size=batch_size):
+            start = stats["rows_parsed"] + 1
+            stats["rows_parsed"] += len(rows)
+
+            if value == FileUploadType.invoice:
+                batch_party, batch_invoice, batch_product, overridden_invoice_ids = await prepare_invoice_upload_data(
+                    db, rows, current_user, upload_state=invoice_state)
+                party_rows.extend(batch_party)
+                invoice_rows.extend(batch_invoice)
+                product_rows.extend(batch_product)
+
+            elif value == FileUploadType.party_master:
+                prepared = await prepare_party_master_data(db, rows, current_user)
+                await save_party_master_data(db, prepared)
+                stats["rows_written"] += len(prepared)
+
+            elif value == FileUploadType.product_master:
+                records = await prepare_product_master_data(rows, current_user, offload=offload)
+                result = await save_product_master_data(db, records, delta=delta)
+                if delta:
+                    for key, count in result["data"].items():
+                        stats[f"rows_{key}"] = stats.get(f"rows_{key}", 0) + count
+                    stats["rows_written"] += result["data"]["inserted"] + result["data"]["updated"]
+                else:
+                    stats["rows_written"] += len(records)
+
+            elif value == FileUploadType.rack_master:
+                await check_rack_no_rack_master(rows, start=start)
+                prepared = await prepare_rack_master_data(db, rows, current_user)
+                await save_rack_master_data(db, prepared)
+                stats["rows_written"] += len(prepared)
+
+            elif value == FileUploadType.tray_master:
+                await check_tray_no_tray_master(db, rows, start=start)
+                prepared = await prepare_tray_master_data(rows)
+                await save_tray_master_data(db, prepared)
+                stats["rows_written"] += len(prepared)
+
+            stats["batches"] += 1
+            update_upload_throughput(stats, started)
+            logger.info(f"process_upload_stream: {value.value} batch {stats['batches']} done, {stats['rows_parsed']} rows parsed")
+            await asyncio.sleep(batch_pause)
+
+        if value == FileUploadType.invoice:
+            await save_invoice_upload_data(db, party_rows, invoice_rows, product_rows, overridden_invoice_ids)
+            stats["rows_written"] = len(product_rows)
+
+        update_upload_throughput(stats, started)
+        logger.info(f"process_upload_stream: {value.value} finished {stats}")
+        return stats
+    except HTTPException as e:
+        raise report_committed_rows(e, stats)
+    except Exception as e:
+        logger.exception(f"process_upload_stream: {e}")
+        raise report_committed_rows(HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]}), stats)
+
+
+def report_committed_rows(error: HTTPException, stats: dict) -> HTTPException:
+    """Adds the rows of the batches committed before a stream failed to the error detail."""
+    if isinstance(error.detail, dict):
+        error.detail["rows_committed"] = stats["rows_written"]
+    if stats["rows_written"]:
+        logger.error(f"process_upload_stream: {stats['rows_written']} rows were committed before the error")
+    return error
+
+
+# ------------------------------ Upload history ------------------------------
+
+async def upload_file_hash(file) -> str:
+    """sha256 of the uploaded bytes, read in chunks; the file is rewound for the upload itself."""
+    digest = hashlib.sha256()
+    chunk_size = settings.UPLOAD_CHUNK_SIZE_KB * 1024
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def get_cached_upload(db, value: FileUploadType, file_hash: str) -> dict | None:
+    """
+    Result of the most recent successful upload of this type when it was the same file, or None.
+    An older upload of the same file does not count: a later file may have changed the data since.
+    """
+    result = await db.execute(
+        text("""
+            SELECT id, result, updated_at FROM upload_history
+            WHERE file_type = :file_type AND file_hash = :file_hash AND is_latest = 1
+        """), {"file_type": value.value, "file_hash": file_hash}
+    )
+    row = result.mappings().first()
+    if not row:
+        return None
+
+    await db.execute(
+        text("UPDATE upload_history SET skipped_count = skipped_count + 1 WHERE id = :id"), {"id": row["id"]}
+    )
+    await db.commit()
+    stored = row["result"]
+    if isinstance(stored, str):
+        stored = json.loads(stored)
+    return {**(stored or {}), "cached": True, "uploaded_at": row["updated_at"]}
+
+
+async def save_upload_history(db, value: FileUploadType, file, file_hash: str, result: dict, current_user):
+    """Records the upload result as the latest of its type, so a repeat of the same file is answered from upload_history."""
+    try:
+        now = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+        await db.execute(
+            text("UPDATE upload_history SET is_latest = 0 WHERE file_type = :file_type AND is_latest = 1"),
+            {"file_type": value.value}
+        )
+        await db.execute(
+            text("""
+                INSERT INTO upload_history (id, file_type, file_hash, filename, file_size, result,
+                    skipped_count, is_latest, updated_by, created_at, updated_at)
+                VALUES (:id, :file_type, :file_hash, :filename, :file_size, :result,
+                    0, 1, :updated_by, :created_at, :updated_at)
+                ON CONFLICT(file_type, file_hash)
+                    DO UPDATE SET
+                    filename = excluded.filename,
+                    result = excluded.result,
+                    is_latest = 1,
+                    updated_by = excluded.updated_by,
+                    updated_at = excluded.updated_at
+            """), {
+                "id": str(uuid.uuid4()),
+                "file_type": value.value,
+                "file_hash": file_hash,
+                "filename": file.filename,
+                "file_size": file.size,
+                "result": json.dumps(result, default=str),
+                "updated_by": current_user.id,
+                "created_at": now,
+                "updated_at": now,
+            }
+        )
+        await db.commit()
+    except Exception as e:
+        # The upload itself succeeded; a missing history row only means the next repeat is re-ingested
+        await db.rollback()
+        logger.exception(f"save_upload_history: {e}")
+
+
+async def forget_uploads(db, value: FileUploadType):
+    """Drops the upload history of a file type whose data was changed outside an upload; the caller commits."""
+    await db.execute(text("DELETE FROM upload_history WHERE file_type = :file_type"), {"file_type": value.value})
+
+
+# ------------------------------ Bundle uploads ------------------------------
+
+# Masters first so invoice parties and rack numbers resolve against the rows of the same bundle
+UPLOAD_BUNDLE_ORDER = (
+    FileUploadType.party_master,
+    FileUploadType.product_master,
+    FileUploadType.rack_master,
+    FileUploadType.tray_master,
+    FileUploadType.invoice,
+)
+
+
+async def read_upload_rows(file) -> list[dict]:
+    rows = []
+    async for batch in stream_csv_rows(file):
+        rows.extend(batch)
+    return rows
+
+
+async def parse_bundle_file(file, value: FileUploadType, current_user) -> dict:
+    """CSV parsing plus the preparation that needs no DB; runs concurrently for all files of a bundle."""
+    rows = await read_upload_rows(file)
+    parsed = {"rows": rows}
+    if value == FileUploadType.product_master:
+        parsed["records"] = await prepare_product_master_data(rows, current_user)
+    elif value == FileUploadType.rack_master:
+        await check_rack_no_rack_master(rows)
+    elif value == FileUploadType.tray_master:
+        parsed["records"] = await prepare_tray_master_data(rows)
+    logger.info(f"parse_bundle_file: {value.value} {file.filename} {len(rows)} rows parsed")
+    return parsed
+
+
+async def save_bundle_file(db, value: FileUploadType, parsed: dict, current_user) -> int:
+    """Writes one parsed bundle file without committing and returns the number of rows written."""
+    rows = parsed["rows"]
+    if value == FileUploadType.party_master:
+        prepared = await prepare_party_master_data(db, rows, current_user)
+        await save_party_master_data(db, prepared, commit=False)
+        return len(prepared)
+
+    if value == FileUploadType.product_master:
+        await save_product_master_data(db, parsed["records"], commit=False)
+        return len(parsed["records"])
+
+    if value == FileUploadType.rack_master:
+        prepared = await prepare_rack_master_data(db, rows, current_user)
+        await save_rack_master_data(db, prepared, commit=False)
+        return len(prepared)
+
+    if value == FileUploadType.tray_master:
+        await check_tray_no_tray_master(db, rows)
+        await save_tray_master_data(db, parsed["records"], commit=False)
+        return len(parsed["records"])
+
+    party_rows, invoice_rows, product_rows, overridden_invoice_ids = await prepare_invoice_upload_data(db, rows, current_user)
+    await save_invoice_upload_data(db, party_rows, invoice_rows, product_rows, overridden_invoice_ids, commit=False)
+    return len(product_rows)
+
+
+async def process_upload_bundle(db, files: list, values: list[FileUploadType], current_user) -> dict:
+    """
+    Uploads several master / invoice files in one request. Files are parsed concurrently, then
+    written in UPLOAD_BUNDLE_ORDER inside one transaction that is committed once, so either the
+    whole bundle is stored or nothing is. The upload history of every type in the bundle is dropped
+    in that transaction, so re-uploading an earlier file afterwards is ingested again.
+    """
+    started = time.perf_counter()
+    try:
+        if len(files) != len(values):
+            logger.error(f"Bundle upload got {len(files)} files for {len(values)} values")
+            raise HTTPException(status_code=400, detail={"status": "error",
+                    "message": f"Each file needs a value: got {len(files)} files and {len(values)} values"})
+        duplicates = sorted({value.value for value in values if values.count(value) > 1})
+        if duplicates:
+            logger.error(f"Bundle upload has more than one file for {duplicates}")
+            raise HTTPException(status_code=400, detail={"status": "error",
+                    "message": f"Only one file per type is allowed in a bundle, got more for {', '.join(duplicates)}"})
+
+        bundle = dict(zip(values, files))
+        for file in files:
+            check_upload_filename(file.filename)
+
+        order = [value for value in UPLOAD_BUNDLE_ORDER if value in bundle]
+        parsed_files = await asyncio.gather(*[parse_bundle_file(bundle[value], value, current_user) for value in order])
+
+        results = {}
+        try:
+            for value, parsed in zip(order, parsed_files):
+                rows_written = await save_bundle_file(db, value, parsed, current_user)
+                await forget_uploads(db, value)
+                results[value.value] = {
+                    "filename": bundle[value].filename,
+                    "rows_parsed": len(parsed["rows"]),
+                    "rows_written": rows_written,
+                }
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            if FileUploadType.product_master in bundle:
+                # The indexes were refreshed from rows that are now rolled back
+                product_rack_index.invalidate()
+                product_catalog.invalidate()
+                invalidate_invoice_matches()
+            raise
+        if FileUploadType.product_master in bundle or FileUploadType.invoice in bundle:
+            # Only now can scans read the bundle; answers cached while it was being written are stale
+            invalidate_invoice_matches()
+
+        summary = {
+            "order": [value.value for value in order],
+            "files": results,
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+        }
+        logger.info(f"process_upload_bundle: {summary}")
+        return summary
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"process_upload_bundle: {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
+# ------------------------------ Background upload jobs ------------------------------
+
+UPLOAD_JOBS: dict[str, dict] = {}
+upload_job_semaphore = asyncio.Semaphore(settings.UPLOAD_JOB_CONCURRENCY)
+upload_job_tasks = set()
+
+
+def prune_upload_jobs():
+    cutoff = datetime.now() - timedelta(minutes=settings.UPLOAD_JOB_RETENTION_MINUTES)
+    for job_id, job in list(UPLOAD_JOBS.items()):
+        if job["finished_at"] and job["finished_dt"] < cutoff:
+            UPLOAD_JOBS.pop(job_id, None)
+
+
+def upload_job_view(job: dict) -> dict:
+    return {
+        "job_id": job["job_id"],
+        "file_type": job["file_type"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "rows_parsed": job["stats"]["rows_parsed"],
+        "rows_written": job["stats"]["rows_written"],
+        "batches": job["stats"]["batches"],
+        "elapsed_seconds": job["stats"]["elapsed_seconds"],
+        "rows_per_second": job["stats"]["rows_per_second"],
+        "errors": job["errors"],
+    }
+
+
+async def spool_upload_file(file) -> str:
+    """Copies the upload to a temp file in chunks; the request's UploadFile is closed once the response is sent."""
+    chunk_size = settings.UPLOAD_CHUNK_SIZE_KB * 1024
+    tmp = tempfile.NamedTemporaryFile(prefix="upload_job_", delete=False)
+    try:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            await run_in_threadpool(tmp.write, chunk)
+    finally:
+        tmp.close()
+    return tmp.name
+
+
+async def create_upload_job(file, value: FileUploadType, current_user, delta: bool = False,
+                            file_hash: str | None = None) -> dict:
+    try:
+        check_upload_filename(file.filename)
+        prune_upload_jobs()
+
+        pending = [job for job in UPLOAD_JOBS.values() if job["status"] in ("queued", "running")]
+        if len(pending) >= settings.UPLOAD_JOB_MAX_PENDING:
+            logger.error(f"Upload job queue is full ({len(pending)} pending)")
+            raise HTTPException(status_code=429, detail={"status": "error",
+                    "message": f"Upload job queue is full ({len(pending)} pending), try again later"})
+
+        size = file.size
+        path = await spool_upload_file(file)
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "file_type": value.value,
+            "filename": file.filename,
+            "file_size": size,
+            "status": "queued",
+            "created_at": datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+            "started_at": None,
+            "finished_at": None,
+            "finished_dt": None,
+            "stats": new_upload_stats(value),
+            "errors": [],
+        }
+        UPLOAD_JOBS[job_id] = job
+
+        task = asyncio.create_task(run_upload_job(job, path, value, current_user, delta, file_hash))
+        upload_job_tasks.add(task)
+        task.add_done_callback(upload_job_tasks.discard)
+        logger.info(f"Upload job {job_id} queued for {value.value} file {file.filename}")
+        return upload_job_view(job)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"create_upload_job: {e}")
+        raise HTTPException(status_code=400, detail={"status" : "error",
+                "message" : str(e).split("\n")[0][:100]})
+
+
+async def run_upload_job(job: dict, path: str, value: FileUploadType, current_user, delta: bool = False,
+                         file_hash: str | None = None):
+    """Runs one queued upload; at most UPLOAD_JOB_CONCURRENCY jobs process at the same time."""
+    try:
+        async with upload_job_semaphore:
+            job["status"] = "running"
+            job["started_at"] = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+            with open(path, "rb") as spooled:
+                upload = UploadFile(file=spooled, filename=job["filename"], size=job["file_size"])
+                async with async_session() as db:
+                    await process_upload_stream(db, upload, value, current_user, stats=job["stats"],
+                                                batch_pause=settings.UPLOAD_JOB_BATCH_PAUSE_MS / 1000, delta=delta,
+                                                batch_size=settings.UPLOAD_JOB_BATCH_SIZE, offload=True)
+                    if file_hash:
+                        await save_upload_history(db, value, upload, file_hash, {
+                            "status": "success",
+                            "message": UPLOAD_SUCCESS_MESSAGES[value],
+                            "data": job["stats"],
+                        }, current_user)
+            job["status"] = "completed"
+            logger.info(f"Upload job {job['job_id']} completed: {job['stats']}")
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["errors"].append(e.detail)
+        logger.error(f"Upload job {job['job_id']} failed: {e.detail}")
+    except Exception as e:
+        job["status"] = "failed"
+        job["errors"].append({"status": "error", "message": str(e).split("\n")[0][:100]})
+        logger.exception(f"Upload job {job['job_id']} failed: {e}")
+    finally:
+        job["finished_dt"] = datetime.now()
+        job["finished_at"] = job["finished_dt"].strftime("%d-%m-%Y %H:%M:%S")
+        try:
+            os.remove(path)
+        except OSError:
+            logger.warning(f"Could not remove spooled upload {path}")
+
+
+def get_upload_job(job_id: str) -> dict:
+    job = UPLOAD_JOBS.get(job_id)
+    if not job:
+        logger.error(f"Upload job {job_id} not found")
+        raise HTTPException(status_code=404, detail={"status": "error", "message": f"Upload job {job_id} not found"})
+    return upload_job_view(job)
@@ -0,0 +1,97 @@
+import os
+import random
+import shutil
+import sqlite3
+import string
+from pathlib import Path
+
+import pytest
+
+# src.core.config reads the environment when first imported
+for name, value in {
+    "DATABASE_URL": "sqlite+aiosqlite:///:memory:",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+    "REFRESH_TOKEN_EXPIRE_DAYS": "1",
+    "JWT_SECRET_KEY": "test",
+    "JWT_ALGORITHM": "HS256",
+}.items():
+    os.environ.setdefault(name, value)
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from src.core.config import settings
+from src.helpers.invoices import normalize_batch_key
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def make_products(count: int, seed: int = 0) -> list[dict]:
+    """Deterministic product_master rows: batches reused across items, shared expiry / mfg dates and MRPs."""
+    rng = random.Random(seed)
+    batches = ["".join(rng.choices(string.ascii_uppercase, k=2)) + str(rng.randint(10000, 99999))
+               for _ in range(max(count // 3, 1))]
+    return [
+        {
+            "id": f"prod{index}",
+            "item_code": f"ITEM{index % 500}",
+            "product_name": f"Product {index % 500}",
+            "batch_number": rng.choice(batches),
+            "expiry_date": f"{rng.randint(1, 12):02d}-{rng.randint(2025, 2027)}",
+            "mfg_date": f"{rng.randint(1, 12):02d}-2024" if rng.random() < 0.7 else None,
+            "mrp": float(rng.randint(20, 60)),
+            "barcode1": f"890{index:07d}" if rng.random() < 0.3 else None,
+            "barcode2": f"990{index % 700:07d}" if rng.random() < 0.2 else None,
+        }
+        for index in range(count)
+    ]
+
+
+@pytest.fixture(scope="session")
+def migrated_template(tmp_path_factory) -> Path:
+    """SQLite database migrated to the alembic head once per test session."""
+    path = tmp_path_factory.mktemp("template") / "head.db"
+    database_url = settings.DATABASE_URL
+    settings.DATABASE_URL = f"sqlite+aiosqlite:///{path}"
+    try:
+        command.upgrade(Config(str(ROOT / "alembic.ini")), "head")
+    finally:
+        settings.DATABASE_URL = database_url
+    return path
+
+
+@pytest.fixture
+def sqlite_path(migrated_template, tmp_path) -> Path:
+    """Fresh copy of the migrated database for one test."""
+    path = tmp_path / "test.db"
+    shutil.copy(migrated_template, path)
+    return path
+
+
+@pytest.fixture
+def seed_products(sqlite_path):
+    def seed(products: list[dict]):
+        with sqlite3.connect(sqlite_path) as conn:
+            conn.executemany(
+                """
+                INSERT INTO product_master (id, item_code, product_name, batch_number, batch_key, expiry_date,
+                    mfg_date, mrp, barcode1, barcode2)
+                VALUES (:id, :item_code, :product_name, :batch_number, :batch_key, :expiry_date,
+                    :mfg_date, :mrp, :barcode1, :barcode2)
+                """,
+                [{**product, "batch_key": normalize_batch_key(product["batch_number"])} for product in products],
+            )
+    return seed
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(sqlite_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{sqlite_path}")
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    await engine.dispose()
@@ -0,0 +1,83 @@
+"""
+The n-gram index narrows fuzzy batch candidates before rapidfuzz scoring; it must never drop a batch that
+unnarrowed scoring keeps at the cutoff (BATCH_NGRAM_MIN_SCORE).
+"""
+import random
+import string
+
+from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
+
+from conftest import make_products
+from src.core.config import settings
+from src.services.product_catalog import ProductCatalog, PRODUCT_COLUMNS, BATCH_NGRAM_MIN_SCORE
+from src.services.products import CatalogFinder
+
+
+def make_batches(rng: random.Random) -> list[str]:
+    """Batch numbers in the formats seen in uploads: plain, separated, multi-token, short and long."""
+    batches = {product["batch_number"] for product in make_products(3000, seed=16)}
+    for _ in range(1500):
+        letters = "".join(rng.choices(string.ascii_uppercase, k=rng.randint(1, 4)))
+        digits = str(rng.randint(1, 10 ** rng.randint(2, 7)))
+        batches.add(rng.choice([
+            f"{letters}{digits}", f"{letters}-{digits}", f"{letters} {digits}", f"{digits}{letters}",
+            f"{letters}{digits}/{rng.randint(1, 99)}", f"{digits}", f"{letters[:2]}{digits[:2]}",
+        ]))
+    return sorted(batches)
+
+
+def mutate(batch: str, rng: random.Random) -> str:
+    """A scanned batch: substituted, inserted, deleted or swapped characters, case and separator changes."""
+    chars = list(batch)
+    kind = rng.randrange(7)
+    position = rng.randrange(len(chars))
+    if kind == 0:
+        chars[position] = rng.choice(string.ascii_uppercase + string.digits)
+    elif kind == 1:
+        chars.insert(position, rng.choice(string.digits))
+    elif kind == 2 and len(chars) > 1:
+        del chars[position]
+    elif kind == 3 and position + 1 < len(chars):
+        chars[position], chars[position + 1] = chars[position + 1], chars[position]
+    elif kind == 4:
+        return batch.lower()
+    elif kind == 5:
+        return " ".join(batch.split("-")[::-1])
+    elif kind == 6:
+        return f"{batch[:position]} {batch[position:]}"
+    return "".join(chars)
+
+
+def test_ngram_candidates_keep_every_batch_at_the_cutoff():
+    rng = random.Random(16)
+    batches = make_batches(rng)
+    catalog = ProductCatalog()
+    catalog.load_rows([
+        (rowid, *(batch if column == "batch_number" else None for column in PRODUCT_COLUMNS))
+        for rowid, batch in enumerate(batches, start=1)
+    ])
+
+    narrowed = 0
+    for query in [mutate(rng.choice(batches), rng) for _ in range(1500)]:
+        candidates = catalog.batch_candidates(query)
+        if candidates is None:
+            continue
+        narrowed += 1
+        # Finder never matches candidates of 3 characters or less (BatchScorer.matches)
+        expected = {match for match, _, _ in process.extract(
+            query, batches, scorer=fuzz.WRatio, processor=default_process,
+            score_cutoff=BATCH_NGRAM_MIN_SCORE, limit=None) if len(match) > 3}
+        assert expected <= candidates, (query, sorted(expected - candidates))
+    # most scans are long enough to be narrowed
+    assert narrowed > 1000
+
+
+def test_narrowing_is_skipped_below_the_ngram_min_score(monkeypatch):
+    catalog = ProductCatalog()
+    catalog.load_rows([(1, *(("AB12345" if column == "batch_number" else None) for column in PRODUCT_COLUMNS))])
+    finder = CatalogFinder(None, "XY99999", None, None, catalog=catalog)
+
+    assert finder.narrow_batch_candidates("XY99999", ["QQ11111"]) == []
+    monkeypatch.setattr(settings, "PRODUCT_MATCH_FUZZY_SCORE_CUTOFF", BATCH_NGRAM_MIN_SCORE - 10)
+    assert finder.narrow_batch_candidates("XY99999", ["QQ11111"]) == ["QQ11111"]
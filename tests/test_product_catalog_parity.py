@@ -0,0 +1,131 @@
+"""
+CatalogFinder over an in-memory ProductCatalog must return what Finder returns from product_master,
+in the same order, for every kind of scan, also after incremental refreshes and a full reload.
+"""
+import random
+import sqlite3
+
+import pytest
+
+from conftest import make_products
+from src.services.product_catalog import ProductCatalog
+from src.services.products import Finder, CatalogFinder
+
+pytestmark = pytest.mark.anyio
+
+
+def make_scans(products: list[dict], count: int, seed: int) -> list[dict]:
+    """Scans of the products: exact and typo batches, unknown batches, shifted MRPs, wrong mfg dates, barcodes."""
+    rng = random.Random(seed)
+    scans = []
+    for index in range(count):
+        product = rng.choice(products)
+        batch = product["batch_number"]
+        scan = {"batch_number": batch, "expiry_date": product["expiry_date"], "mrp": product["mrp"],
+                "mfg_date": product["mfg_date"]}
+        kind = index % 8
+        if kind == 1:
+            position = rng.randrange(2, len(batch))
+            scan["batch_number"] = batch[:position] + rng.choice("0123456789") + batch[position + 1:]
+        elif kind == 2:
+            scan["batch_number"] = "".join(rng.choices("QWXYZ", k=2)) + str(rng.randint(10000, 99999))
+        elif kind == 3:
+            scan["mrp"] = product["mrp"] + rng.choice([-2, -1, -0.5, 0.5, 1, 2])
+        elif kind == 4:
+            scan["mfg_date"] = f"{rng.randint(1, 12):02d}-2023"
+        elif kind == 5:
+            scan["barcode1"] = product["barcode1"] or f"890{rng.randint(0, 9999999):07d}"
+        elif kind == 6:
+            scan["barcode2"] = product["barcode2"] or "000000"
+            scan["batch_number"] = batch.lower()
+        elif kind == 7:
+            scan["batch_number"] = f"{batch[:2]}-{batch[2:]}".replace("0", "O")
+        scans.append(scan)
+    return scans
+
+
+async def mismatches(db, catalog: ProductCatalog, scans: list[dict]) -> list:
+    await catalog.ensure_loaded(db)
+    found = []
+    for scan in scans:
+        args = (scan["batch_number"], scan["expiry_date"], scan["mrp"], scan["mfg_date"],
+                scan.get("barcode1"), scan.get("barcode2"))
+        expected = [product["id"] for product in await Finder(db, *args).search()]
+        actual = [product["id"] for product in await CatalogFinder(db, *args, catalog=catalog).search()]
+        if actual != expected:
+            found.append((scan, expected, actual))
+    return found
+
+
+def bump_version(sqlite_path) -> int:
+    """What save_product_master_data does to data_versions, from a connection of its own."""
+    with sqlite3.connect(sqlite_path) as conn:
+        return conn.execute(
+            "UPDATE data_versions SET version = version + 1 WHERE name = 'product_master' RETURNING version"
+        ).fetchone()[0]
+
+
+@pytest.fixture
+def products(seed_products):
+    products = make_products(3000, seed=15)
+    seed_products(products)
+    return products
+
+
+async def test_catalog_finder_matches_finder(db, products):
+    assert await mismatches(db, ProductCatalog(), make_scans(products, 600, seed=1)) == []
+
+
+async def test_catalog_finder_matches_finder_after_refresh_items(db, products, seed_products, sqlite_path):
+    catalog = ProductCatalog()
+    await catalog.ensure_loaded(db)
+
+    # A product master upload: changed MRPs, mfg dates and barcodes of existing rows plus new rows
+    changed = random.Random(2).sample(products, 300)
+    with sqlite3.connect(sqlite_path) as conn:
+        for index, product in enumerate(changed):
+            conn.execute(
+                "UPDATE product_master SET mrp = :mrp, mfg_date = :mfg_date, barcode1 = :barcode1 WHERE id = :id",
+                {"id": product["id"], "mrp": product["mrp"] + 1, "mfg_date": "06-2024", "barcode1": f"777{index:07d}"},
+            )
+    added = [{**product, "id": f"new{product['id']}", "item_code": changed[index % len(changed)]["item_code"]}
+             for index, product in enumerate(make_products(200, seed=16))]
+    seed_products(added)
+    version = bump_version(sqlite_path)
+    await db.commit()
+
+    await catalog.refresh_items(db, changed + added, version)
+    assert catalog.version == version
+    scans = make_scans(products + added, 600, seed=3)
+    assert await mismatches(db, catalog, scans) == []
+    assert catalog.version == version
+
+
+async def test_catalog_reloads_after_a_save_in_another_worker(db, products, seed_products, sqlite_path):
+    catalog = ProductCatalog()
+    await catalog.ensure_loaded(db)
+    loaded_version = catalog.version
+
+    # Another worker's upload: its rows and version bump arrive through a second connection
+    added = [{**product, "id": f"new{product['id']}"} for product in make_products(300, seed=18)]
+    seed_products(added)
+    version = bump_version(sqlite_path)
+    await db.commit()
+
+    await catalog.ensure_loaded(db)
+    assert catalog.version == version != loaded_version
+    assert len(catalog) == len(products) + len(added)
+    assert await mismatches(db, catalog, make_scans(products + added, 600, seed=5)) == []
+
+
+async def test_catalog_finder_matches_finder_after_invalidate(db, products, seed_products):
+    catalog = ProductCatalog()
+    await catalog.ensure_loaded(db)
+
+    added = [{**product, "id": f"new{product['id']}"} for product in make_products(300, seed=17)]
+    seed_products(added)
+    await db.commit()
+    catalog.invalidate()
+
+    assert not catalog.loaded
+    assert await mismatches(db, catalog, make_scans(products + added, 600, seed=4)) == []
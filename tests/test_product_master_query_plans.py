@@ -0,0 +1,74 @@
+"""
+Every query Finder runs against product_master must be answered through an index: EXPLAIN QUERY PLAN
+of each recorded query shape may not contain a SCAN of the table.
+"""
+import sqlite3
+
+import pytest
+
+from conftest import make_products
+from src.services.products import Finder
+
+pytestmark = pytest.mark.anyio
+
+
+class RecordingSession:
+    """AsyncSession stand-in that keeps the SQL and params of every statement it executes."""
+
+    def __init__(self, session):
+        self.session = session
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        self.statements.append((str(statement), dict(params or {})))
+        return await self.session.execute(statement, params)
+
+
+# Finder query shape → text identifying its statements
+QUERY_SHAPES = {
+    "batch": "WHERE batch_number = :batch",
+    "batch_key": "WHERE batch_key = :batch_key",
+    "barcode": "WHERE barcode1 = :barcode OR barcode2 = :barcode",
+    "expiry_mfg_mrp": "expiry_date = :expiry_date AND mfg_date = :mfg_date AND (mrp >=",
+    "expiry_mrp": "expiry_date = :expiry_date AND (mrp >=",
+    "mfg_mrp": "WHERE\n        mfg_date = :mfg_date AND (mrp >=",
+    "batch_in": "AND batch_number IN (",
+}
+
+
+@pytest.fixture
+async def finder_statements(db, seed_products):
+    products = make_products(3000, seed=14)
+    seed_products(products)
+    product = next(p for p in products if p["barcode1"] and p["mfg_date"])
+    batch = product["batch_number"]
+    typo = batch[:-1] + ("0" if batch[-1] != "0" else "1")
+    scans = [
+        # barcode hit
+        dict(batch_number=batch, expiry_date=product["expiry_date"], mrp=product["mrp"], barcode1=product["barcode1"]),
+        # exact batch
+        dict(batch_number=batch, expiry_date=product["expiry_date"], mrp=product["mrp"]),
+        # batch key: lower case with a dash
+        dict(batch_number=f"{batch[:2].lower()}-{batch[2:]}", expiry_date=product["expiry_date"], mrp=product["mrp"]),
+        # fuzzy with expiry, mfg and MRP, then the IN re-query of the matched batches
+        dict(batch_number=typo, expiry_date=product["expiry_date"], mrp=product["mrp"], mfg_date=product["mfg_date"]),
+        # no product with this mfg date: fuzzy again without it
+        dict(batch_number="ZZ00000", expiry_date=product["expiry_date"], mrp=product["mrp"], mfg_date="01-1999"),
+        # fuzzy on mfg date and MRP only
+        dict(batch_number=typo, expiry_date=None, mrp=product["mrp"], mfg_date=product["mfg_date"]),
+    ]
+    recorder = RecordingSession(db)
+    for scan in scans:
+        await Finder(recorder, scan.pop("batch_number"), scan.pop("expiry_date"), scan.pop("mrp"), **scan).search()
+    return recorder.statements
+
+
+@pytest.mark.parametrize("shape", QUERY_SHAPES)
+async def test_finder_query_uses_an_index(shape, finder_statements, sqlite_path):
+    statements = [(sql, params) for sql, params in finder_statements if QUERY_SHAPES[shape] in sql]
+    assert statements, f"no {shape} query recorded"
+    with sqlite3.connect(sqlite_path) as conn:
+        for sql, params in statements:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            assert not any(step.startswith("SCAN product_master") for step in plan), (shape, plan, sql)
+            assert any(step.startswith("SEARCH product_master") for step in plan), (shape, plan, sql)
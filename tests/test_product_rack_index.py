@@ -0,0 +1,63 @@
+"""
+ProductRackIndex instances stand in for the indexes of two worker processes sharing one database:
+a product master save by either must show up in the other's rack lookups.
+"""
+import pytest
+from sqlalchemy import text
+
+from conftest import make_products
+from src.services.product_index import ProductRackIndex, bump_data_version, PRODUCT_MASTER_VERSION
+
+pytestmark = pytest.mark.anyio
+
+
+async def save_rack_no(db, product: dict, rack_no: str) -> int:
+    """What save_product_master_data does for one row, without touching the module's index."""
+    await db.execute(text("UPDATE product_master SET rack_no = :rack_no WHERE id = :id"),
+                     {"rack_no": rack_no, "id": product["id"]})
+    version = await bump_data_version(db, PRODUCT_MASTER_VERSION)
+    await db.commit()
+    return version
+
+
+def rack_of(index: ProductRackIndex, product: dict) -> str:
+    return index.get_rack_no(product["product_name"], product["batch_number"], product["expiry_date"],
+                             product["mrp"])
+
+
+@pytest.fixture
+def products(seed_products):
+    products = make_products(300, seed=3)
+    seed_products(products)
+    return products
+
+
+async def test_index_reloads_after_a_save_in_another_worker(db, products):
+    worker, other_worker = ProductRackIndex(), ProductRackIndex()
+    await worker.ensure_loaded(db)
+    assert rack_of(worker, products[0]) == "0"
+
+    await other_worker.ensure_loaded(db)
+    version = await save_rack_no(db, products[0], "R7")
+    await other_worker.refresh_items(db, [products[0]], version)
+    assert rack_of(other_worker, products[0]) == "R7"
+
+    await worker.ensure_loaded(db)
+    assert worker.version == version
+    assert rack_of(worker, products[0]) == "R7"
+
+
+async def test_refresh_items_leaves_a_missed_save_to_ensure_loaded(db, products):
+    index = ProductRackIndex()
+    await index.ensure_loaded(db)
+    loaded_version = index.version
+
+    await save_rack_no(db, products[1], "R1")
+    version = await save_rack_no(db, products[2], "R2")
+    await index.refresh_items(db, [products[2]], version)
+    assert index.version == loaded_version
+
+    await index.ensure_loaded(db)
+    assert index.version == version
+    assert rack_of(index, products[1]) == "R1"
+    assert rack_of(index, products[2]) == "R2"